@@ -1,10 +1,26 @@
 #!/usr/bin/env python
+"""
+Simple Gaussian process regression. It assumes a zero mean GP prior.
 
-import numpy as np
-import matplotlib.pyplot as pl
+The module only depends on numpy at import time so that the kernel and the
+prediction code can be used from short-lived worker processes. scipy is
+imported on the first fit/predict and matplotlib only when a plot is
+requested (see gp_plot.py). Kernel matrices are evaluated in tiles under a
+memory budget (see gp_tiles.py), so large test sets can be predicted, or
+streamed with predict_tiles(), without building len(X) x len(Xtest)
+temporaries. Import time and memory can be checked with
+
+    python -X importtime -c "import gp"
+
+Running the module as a script reproduces the original demo and writes
+predictive.png, prior.png and post.png.
+"""
+
+import warnings
 
-""" This is code for simple GP regression. It assumes a zero mean GP Prior """
+import numpy as np
 
+import gp_tiles
 
 # This is the true unknown function we are trying to approximate
 
@@ -19,83 +35,468 @@ f = lambda x: np.sin(0.9*x).flatten()
 ## -- Kernel function -- ##
 ###########################
 
-def kernel(a, b):
-    """ GP squared exponential kernel """
-    kernelParameter = 0.1
-    sqdist = np.sum(a**2,1).reshape(-1,1) + np.sum(b**2,1) - 2*np.dot(a, b.T)
-    return np.exp(-.5 * (1/kernelParameter) * sqdist)
+class SquaredExponential:
+    """ GP squared exponential kernel
+
+        k(a, b) = variance * exp(-0.5 * sum_d (a_d - b_d)^2 / length_scale_d^2)
+
+        length_scale can be a scalar or one value per input dimension (ARD).
+
+        Kernels are callables k(a, b, out=None) returning the len(a) x len(b)
+        kernel matrix, computed in place in the C-contiguous array out if given.
+        diag(a) returns only the diagonal of k(a, a), which for a stationary
+        kernel is a constant.
+
+        The hyperparameters are exposed as theta = log([length_scale..., variance])
+        for optimisation (see gp_optimize.py)."""
+
+    stationary = True
+
+    def __init__(self, length_scale=np.sqrt(0.1), variance=1.0):
+        self.length_scale = length_scale
+        self.variance = variance
+
+    def __call__(self, a, b, out=None):
+        # - Stay in the input precision for floating inputs, integers go to float64
+        length_scale = np.asarray(self.length_scale, dtype=np.result_type(a.dtype, b.dtype, np.float32))
+        a = a / length_scale
+        b = b / length_scale
+        sqdist = np.dot(a, b.T, out=out)
+        sqdist *= -2
+        sqdist += np.sum(a**2,1).reshape(-1,1)
+        sqdist += np.sum(b**2,1)
+        sqdist *= -.5
+        np.exp(sqdist, out=sqdist)
+        if self.variance != 1.0:
+            sqdist *= self.variance
+        return sqdist
+
+    def diag(self, a):
+        return np.full(len(a), float(self.variance))
+
+    def sample_frequencies(self, n_features, n_dims, random_state=None):
+        """Draw n_features frequencies from the spectral density of the kernel,
+           used for random Fourier features (see gp_sampling.py)."""
+        rng = np.random.default_rng(random_state)
+        return rng.standard_normal((n_features, n_dims)) / self.length_scale
+
+    @property
+    def theta(self):
+        return np.log(np.append(self.length_scale, self.variance))
+
+    def clone_with_theta(self, theta):
+        """New kernel with hyperparameters theta = log([length_scale..., variance])."""
+        theta = np.exp(np.asarray(theta, dtype=float))
+        length_scale = theta[0] if len(theta) == 2 else theta[:-1]
+        return SquaredExponential(length_scale=length_scale, variance=theta[-1])
+
+    def gradient_trace(self, X, W, K):
+        """Traces tr(W dK/dtheta_i) for every hyperparameter, where K = k(X, X) and
+           W is symmetric. Costs O(N^2 D) without forming any dK/dtheta_i."""
+
+        WK = W * K
+        rowsum = WK.sum(axis=1)
+
+        # - dK/dlog(l_d) = K * (x_d - x'_d)^2 / l_d^2
+        Xs = X / self.length_scale
+        grad_l = 2*np.dot(rowsum, Xs**2) - 2*np.einsum('id,id->d', Xs, np.dot(WK, Xs))
+        if np.ndim(self.length_scale) == 0:
+            grad_l = np.atleast_1d(grad_l.sum())
+
+        # - dK/dlog(variance) = K
+        return np.append(grad_l, rowsum.sum())
+
+    def gradient_quadform(self, X, U, W, max_bytes=gp_tiles.DEFAULT_MAX_BYTES):
+        """sum_k U[:,k]^T dK/dtheta_i W[:,k] for every hyperparameter, where
+           K = k(X, X) is only applied in tiles (O(N) memory per column).
+
+           With Xs = X / length_scale, the length scale derivative is
+               u^T dK/dlog(l_d) w = (u Xs_d^2)^T K w - 2 (u Xs_d)^T K (w Xs_d) + u^T K (w Xs_d^2)
+           so all derivatives need one tiled product of K with 2D + 1 blocks of columns."""
+
+        U = U.reshape(len(X), -1)
+        W = W.reshape(len(X), -1)
+        Xs = X / self.length_scale
+        D = Xs.shape[1]
+
+        blocks = [W] + [W * Xs[:,[d]] for d in range(D)] + [W * Xs[:,[d]]**2 for d in range(D)]
+        KW = np.split(gp_tiles.kernel_matvec(self, X, X, np.hstack(blocks), max_bytes), 2*D + 1, axis=1)
+
+        grad_l = np.array([np.sum(U * Xs[:,[d]]**2 * KW[0]) - 2*np.sum(U * Xs[:,[d]] * KW[1 + d])
+                           + np.sum(U * KW[1 + D + d]) for d in range(D)])
+        if np.ndim(self.length_scale) == 0:
+            grad_l = np.atleast_1d(grad_l.sum())
+
+        return np.append(grad_l, np.sum(U * KW[0]))
+
+
+kernel = SquaredExponential()
+
 
+##########################
+## -- Linear algebra -- ##
+##########################
 
-#######################################
+def jittered_cholesky(build, jitter=1e-6, max_tries=6):
+    """Lower Cholesky factor of the symmetric matrix returned by build(),
+       retrying with increasing diagonal jitter if it is not numerically
+       positive definite.
 
-N = 10         # number of training points.
-n = 50         # number of test points.
-s = 0.00005    # noise variance.
+       The first attempt adds nothing, attempt k adds jitter * 10^(k-1) times
+       the mean diagonal. build() is called again for every attempt, because
+       the factorisation is done in place. Returns (L, added jitter)."""
+    from scipy.linalg import cholesky
 
-# Sample some input points and noisy versions of the function evaluated at
-# these points. 
+    added = 0.0
+    for attempt in range(max_tries + 1):
+        A = build()
+        scale = np.mean(np.diag(A))
+        if added:
+            A[np.diag_indices_from(A)] += added
 
-#########################
-## -- Generate data -- ##
-#########################
+        # - A is symmetric, so its transpose is the Fortran ordered matrix LAPACK
+        # - can factorise in place
+        try:
+            return cholesky(A.T, lower=True, overwrite_a=True, check_finite=False), added
+        except np.linalg.LinAlgError:
+            added = jitter * scale * 10**attempt
 
-X = np.random.uniform(-5, 5, size=(N,1))
-y = f(X) + s*np.random.randn(N)
+    raise np.linalg.LinAlgError(
+        "Matrix is not positive definite even after adding {:.2e} to the diagonal".format(added))
 
 
 ############################
 ## -- Gaussian process -- ##
 ############################
 
-K = kernel(X, X)
-L = np.linalg.cholesky(K + s*np.eye(N))
-
-# points we're going to make predictions at.
-Xtest = np.linspace(-5, 5, n).reshape(-1,1)
-
-# compute the mean at our test points.
-Lk = np.linalg.solve(L, kernel(X, Xtest))
-mu = np.dot(Lk.T, np.linalg.solve(L, y))
-
-# compute the variance at our test points.
-K_ = kernel(Xtest, Xtest)
-s2 = np.diag(K_) - np.sum(Lk**2, axis=0)
-s = np.sqrt(s2)
-
-
-########################
-### --- Plotting --- ###
-########################
-
-# PLOTS:
-pl.figure(1)
-pl.clf()
-pl.plot(X, y, 'r+', ms=20)
-pl.plot(Xtest, f(Xtest), 'b-')
-pl.gca().fill_between(Xtest.flat, mu-3*s, mu+3*s, color="#dddddd")
-pl.plot(Xtest, mu, 'r--', lw=2)
-pl.savefig('predictive.png', bbox_inches='tight')
-pl.title('Mean predictions plus 3 st.deviations')
-pl.axis([-5, 5, -3, 3])
-
-# draw samples from the prior at our test points.
-L = np.linalg.cholesky(K_ + 1e-6*np.eye(n))
-f_prior = np.dot(L, np.random.normal(size=(n,10)))
-pl.figure(2)
-pl.clf()
-pl.plot(Xtest, f_prior)
-pl.title('Ten samples from the GP prior')
-pl.axis([-5, 5, -3, 3])
-pl.savefig('prior.png', bbox_inches='tight')
-
-# draw samples from the posterior at our test points.
-L = np.linalg.cholesky(K_ + 1e-6*np.eye(n) - np.dot(Lk.T, Lk))
-f_post = mu.reshape(-1,1) + np.dot(L, np.random.normal(size=(n,10)))
-pl.figure(3)
-pl.clf()
-pl.plot(Xtest, f_post)
-pl.title('Ten samples from the GP posterior')
-pl.axis([-5, 5, -3, 3])
-pl.savefig('post.png', bbox_inches='tight')
-
-#pl.show()
+class GaussianProcessRegressor:
+    """Exact GP regression with a zero mean prior.
+
+       Inputs:
+       - kernel: covariance function k(a, b) returning a len(a) x len(b) matrix
+       - noise: noise variance added to the diagonal of the training kernel matrix
+       - jitter: starting magnitude (relative to the mean diagonal) of the
+         jitter added when a Cholesky factorisation fails, see jittered_cholesky()
+       - max_bytes: memory budget of a single kernel tile
+       - dtype: precision of the kernel tiles and the Cholesky factor. With
+         np.float32 memory is halved and single precision BLAS is used, while
+         alpha is refined to double precision (see _refine_alpha). Single
+         precision needs noise above min_relative_noise times the largest
+         eigenvalue of K, otherwise fit() warns and uses double precision.
+
+       After fit() the model stores:
+       - X_train: training inputs
+       - L: lower Cholesky factor of K + noise*I, its dtype is the precision
+         of the kernel tiles used for prediction
+       - alpha: weight vector L^T \\ (L \\ y)
+       - jitter_added: extra diagonal jitter that was needed to factorise K
+
+       y can be a vector or an N x T matrix of targets sharing the inputs X.
+       The factorisation, and the predictive variance, are then shared by all
+       T outputs and alpha is found with one batched triangular solve.
+
+       These arrays (listed in fitted_arrays) are all that is needed for
+       prediction and are what gp_io.save() writes to disk.
+       """
+
+    fitted_arrays = ('X_train', 'y_train', 'L', 'alpha')
+
+    # - Refinement of alpha when the factor is in reduced precision
+    refine_steps = 50
+    refine_tol = 1e-10
+
+    # - Smallest noise, relative to the largest eigenvalue of K, for which a
+    # - reduced precision factor still gives usable predictions
+    min_relative_noise = 1e-5
+
+    def __init__(self, kernel=kernel, noise=0.00005, jitter=1e-6,
+                 max_bytes=gp_tiles.DEFAULT_MAX_BYTES, dtype=np.float64):
+        self.kernel = kernel
+        self.noise = noise
+        self.jitter = jitter
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+
+    def fit(self, X, y):
+        """Factorise the training kernel matrix and precompute the weights."""
+        from scipy.linalg import cho_solve
+
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        y = np.asarray(y, dtype=float)
+
+        dtype = self.dtype
+        if dtype != np.float64:
+            # - Largest row sum, which bounds the largest eigenvalue of a
+            # - nonnegative kernel matrix
+            largest = np.max(gp_tiles.kernel_matvec(self.kernel, X, X, np.ones(len(X)), self.max_bytes),
+                             initial=0.0)
+            if self.noise < self.min_relative_noise * largest:
+                warnings.warn("noise {:.2e} is too small for {} precision (needs {:.2e}), "
+                              "using float64".format(self.noise, dtype.name, self.min_relative_noise * largest),
+                              RuntimeWarning)
+                dtype = np.dtype(np.float64)
+
+        def build():
+            K = gp_tiles.kernel_matrix(self.kernel, X, X, self.max_bytes, dtype=dtype)
+            K[np.diag_indices_from(K)] += self.noise
+            return K
+
+        self.X_train = X
+        self.y_train = y
+        self.L, self.jitter_added = jittered_cholesky(build, self.jitter)
+        if dtype == np.float64:
+            self.alpha = cho_solve((self.L, True), y, check_finite=False)
+        else:
+            self._refine_alpha()
+
+        return self
+
+    def _refine_alpha(self):
+        """Refine alpha to double precision: conjugate gradients on the double
+           precision system, preconditioned by the reduced precision factor.
+
+           Plain iterative refinement would diverge once cond(K) * eps(dtype)
+           exceeds one, which is common for small noise in float32."""
+        from scipy.linalg import cho_solve
+        from gp_iterative import conjugate_gradient
+
+        shift = self.noise + self.jitter_added
+
+        def matvec(v):
+            return gp_tiles.kernel_matvec(self.kernel, self.X_train, self.X_train, v,
+                                          self.max_bytes) + shift*v
+
+        def precond(r):
+            return cho_solve((self.L, True), r.astype(self.L.dtype), check_finite=False).astype(float)
+
+        self.alpha, self.n_refine, _ = conjugate_gradient(matvec, self.y_train, precond,
+                                                         tol=self.refine_tol, maxiter=self.refine_steps)
+
+    def predict(self, Xtest, return_std=False, return_var=False, return_cov=False):
+        """Predictive mean at Xtest, optionally with the marginal standard
+        deviation or variance, or the full covariance matrix.
+
+        For T outputs the mean is n x T; the variance is the same for every
+        output and is returned once.
+
+        The marginal variances only need the kernel diagonal and cost O(N*n);
+        the n x n test covariance is built only when return_cov is set."""
+
+        Xtest = np.atleast_2d(np.asarray(Xtest, dtype=float))
+
+        if return_cov:
+            return self._predict_cov(Xtest)
+
+        with_var = return_std or return_var
+        mu = np.empty((len(Xtest),) + np.shape(self.y_train)[1:])
+        var = np.empty(len(Xtest)) if with_var else None
+
+        for rows, mu_tile, var_tile in self.predict_tiles(Xtest, return_var=with_var):
+            mu[rows] = mu_tile
+            if with_var:
+                var[rows] = var_tile
+
+        if return_std:
+            return mu, np.sqrt(var)
+        if return_var:
+            return mu, var
+
+        return mu
+
+    def _predict_cov(self, Xtest):
+        """Predictive mean and full n x n covariance at Xtest."""
+        from scipy.linalg import solve_triangular
+
+        Ks = gp_tiles.kernel_matrix(self.kernel, self.X_train, Xtest, self.max_bytes, dtype=self.L.dtype)
+        mu = np.dot(Ks.T, self.alpha)
+        Lk = solve_triangular(self.L, Ks, lower=True, overwrite_b=True, check_finite=False)
+
+        # - The difference of prior and explained covariance is formed in double precision
+        Lk = Lk.astype(float, copy=False)
+        cov = gp_tiles.kernel_matrix(self.kernel, Xtest, Xtest, self.max_bytes)
+        cov -= np.dot(Lk.T, Lk)
+
+        return mu, cov
+
+    def predict_tiles(self, Xtest, return_std=False, return_var=False):
+        """Stream predictions for consecutive blocks of test points.
+
+           Yields (rows, mu, s) where rows is the slice of Xtest covered by the
+           tile and s is the marginal standard deviation (return_std), variance
+           (return_var) or None. Only one tile x len(X_train) kernel block is
+           held in memory at a time."""
+        from scipy.linalg import solve_triangular
+
+        Xtest = np.atleast_2d(np.asarray(Xtest, dtype=float))
+
+        for rows, Ks in gp_tiles.iter_kernel_tiles(self.kernel, Xtest, self.X_train, self.max_bytes,
+                                                   dtype=self.L.dtype):
+            # - The mean is accumulated in double precision, as alpha can be large
+            mu = np.dot(Ks, self.alpha)
+
+            if not (return_std or return_var):
+                yield rows, mu, None
+                continue
+
+            # - Ks.T is Fortran ordered, so the triangular solve works in place
+            Lk = solve_triangular(self.L, Ks.T, lower=True, overwrite_b=True, check_finite=False)
+            # - The variance is a small difference of large terms, accumulate it in double precision
+            s2 = gp_tiles.kernel_diag(self.kernel, Xtest[rows]) - np.einsum('ij,ij->j', Lk, Lk,
+                                                                            dtype=np.float64)
+            np.maximum(s2, 0.0, out=s2)
+
+            yield rows, mu, (np.sqrt(s2) if return_std else s2)
+
+    def restore(self):
+        """Rebuild derived state after the fitted arrays were loaded by gp_io."""
+        return self
+
+    def solve(self, b):
+        """Solve (K + noise*I) x = b with the stored Cholesky factor."""
+        from scipy.linalg import cho_solve
+        return cho_solve((self.L, True), b, check_finite=False)
+
+    def log_marginal_likelihood(self):
+        """Log marginal likelihood log p(y | X) of the fitted model, one value
+        per output for an N x T target matrix."""
+        N = len(self.y_train)
+        return (-0.5*np.einsum('i...,i...->...', self.y_train, self.alpha)
+                - np.sum(np.log(np.diag(self.L))) - 0.5*N*np.log(2*np.pi))
+
+    def inverse_diag(self):
+        """diag((K + noise*I)^-1) from the stored factor L, O(N^3). Models
+           without a dense factor use block solves with identity columns
+           instead, see inverse_diag_by_solve()."""
+        from scipy.linalg import solve_triangular
+
+        if getattr(self, 'L', None) is None:
+            return inverse_diag_by_solve(self.solve, len(self.X_train))
+
+        Linv = solve_triangular(self.L, np.eye(len(self.L)), lower=True, check_finite=False)
+        return np.einsum('ij,ij->j', Linv, Linv)
+
+    def loo_predictive(self):
+        """Closed-form leave-one-out predictions for all training points.
+
+           With K^-1 = (K + noise*I)^-1 (see inverse_diag()):
+               var_i = 1 / [K^-1]_ii,  mu_i = y_i - alpha_i / [K^-1]_ii
+           Returns (mu, var, log predictive density) in one O(N^3) pass instead
+           of N refits."""
+        return _loo(self.y_train, self.alpha, self.inverse_diag())
+
+    def sample_prior(self, Xtest, n_samples=10, random_state=None):
+        """Draw functions from the GP prior at Xtest. The jitter that was needed
+        is stored in sample_jitter_added."""
+        Xtest = np.atleast_2d(np.asarray(Xtest, dtype=float))
+        rng = np.random.default_rng(random_state)
+
+        L, self.sample_jitter_added = jittered_cholesky(
+            lambda: gp_tiles.kernel_matrix(self.kernel, Xtest, Xtest, self.max_bytes), self.jitter)
+
+        return np.dot(L, rng.normal(size=(len(Xtest), n_samples)))
+
+    def sample_posterior(self, Xtest, n_samples=10, random_state=None, method='cholesky'):
+        """Draw functions from the GP posterior at Xtest.
+
+           method='cholesky' factorises the n x n posterior covariance;
+           method='pathwise' uses random Fourier features with Matheron's rule
+           (see gp_sampling.py) at a cost linear in the number of test points."""
+        rng = np.random.default_rng(random_state)
+
+        if method == 'pathwise':
+            import gp_sampling
+            return gp_sampling.PathwiseSampler(self, n_samples, random_state=rng)(Xtest)
+
+        mu, cov = self.predict(Xtest, return_cov=True)
+        L, self.sample_jitter_added = jittered_cholesky(lambda: cov.copy(), self.jitter)
+
+        # - Independent draws for every output share the factor L
+        shape = mu.shape + (n_samples,)
+        draws = np.dot(L, rng.normal(size=(len(mu), int(np.prod(shape[1:])))))
+
+        return mu[..., np.newaxis] + draws.reshape(shape)
+
+
+def inverse_diag_by_solve(solve, N, block=256):
+    """diag(A^-1) of an N x N matrix from solve(B) = A^-1 B, applied to
+       blocks of identity columns. Used by the models without a dense
+       factor; costs N / block block solves."""
+
+    d = np.empty(N)
+    for cols in gp_tiles.iter_slices(N, block):
+        index = np.arange(cols.start, cols.stop)
+        E = np.zeros((N, len(index)))
+        E[index, np.arange(len(index))] = 1.0
+        d[cols] = solve(E)[index, np.arange(len(index))]
+
+    return d
+
+
+def _loo(y, alpha, Kinv_diag):
+    """LOO means, variances and log predictive densities from alpha and diag(K^-1)."""
+
+    var = 1.0 / Kinv_diag
+    shape = var.shape + (1,)*(alpha.ndim - var.ndim)
+    mu = y - alpha * var.reshape(shape)
+    log_density = -0.5*np.log(2*np.pi*var.reshape(shape)) - 0.5*(y - mu)**2 / var.reshape(shape)
+
+    return mu, var, log_density
+
+
+def loo_predictive(X, y, kernels, noises):
+    """Leave-one-out predictions for several candidate hyperparameter settings.
+
+       kernels and noises are sequences of equal length (or noises a scalar).
+       All C kernel matrices are factorised in one batched Cholesky call and the
+       results are stacked along a leading axis of length C: mu and log density
+       are C x N (x T), the variances C x N."""
+
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    y = np.asarray(y, dtype=float)
+    noises = np.broadcast_to(noises, (len(kernels),))
+
+    K = np.stack([k(X, X) for k in kernels])
+    K += noises.reshape(-1,1,1) * np.eye(len(X))
+
+    Linv = np.linalg.inv(np.linalg.cholesky(K))
+    Kinv_diag = np.einsum('cij,cij->cj', Linv, Linv)
+
+    # - alpha = L^-T L^-1 y for every candidate
+    Y = y.reshape(len(X), -1)
+    alpha = np.matmul(np.swapaxes(Linv, 1, 2), np.matmul(Linv, Y)).reshape((len(kernels),) + y.shape)
+
+    return _loo(y, alpha, Kinv_diag)
+
+
+################
+## -- Demo -- ##
+################
+
+def main(N=10, n=50, s=0.00005, random_state=None):
+    """Fit N noisy samples of the truth model and plot the predictions,
+       prior and posterior samples at n test points."""
+
+    import gp_plot
+
+    rng = np.random.default_rng(random_state)
+
+    # Sample some input points and noisy versions of the function evaluated at
+    # these points.
+    X = rng.uniform(-5, 5, size=(N,1))
+    y = f(X) + s*rng.standard_normal(N)
+
+    # points we're going to make predictions at.
+    Xtest = np.linspace(-5, 5, n).reshape(-1,1)
+
+    model = GaussianProcessRegressor(kernel=kernel, noise=s).fit(X, y)
+    mu, std = model.predict(Xtest, return_std=True)
+
+    gp_plot.plot_predictive(X, y, Xtest, mu, std, truth=f, filename='predictive.png')
+    gp_plot.plot_samples(Xtest, model.sample_prior(Xtest, random_state=rng),
+                         title='Ten samples from the GP prior', filename='prior.png')
+    gp_plot.plot_samples(Xtest, model.sample_posterior(Xtest, random_state=rng),
+                         title='Ten samples from the GP posterior', filename='post.png')
+
+
+if __name__ == '__main__':
+    main()
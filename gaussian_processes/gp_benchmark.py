@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the GP regressors.
+
+A sweep runs every combination of training size N, test size n, input
+dimension, dtype and backend, and times the phases of a typical workload
+separately:
+
+    kernel      dense N x N kernel matrix in tiles (skipped above max_kernel_bytes)
+    fit         model.fit(X, y)
+    mean        model.predict(Xtest)
+    variance    model.predict(Xtest, return_var=True), mean included
+    sample      model.sample_posterior(Xtest, n_samples)
+
+Each phase reports the best and mean wall time over `repeat` runs and, when
+memory tracing is on, the peak memory allocated during the phase (numpy
+reports its buffers to tracemalloc). A phase that a backend cannot run
+(e.g. exact samples of a large test set with a kernel that has no spectral
+density for pathwise sampling) or that fails is recorded with a `skipped`
+reason instead of timings, and the sweep goes on. Results are flat records that can be
+written as JSON or CSV and compared between versions, e.g.
+
+    python gp_benchmark.py --N 1000 4000 --n 1000 --dim 1 3 \\
+        --dtype float64 float32 --backend exact iterative --json bench.json
+
+import_cost() measures the import time and resident memory of the core
+module in a fresh interpreter.
+"""
+
+import csv
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import gp
+import gp_tiles
+
+
+PHASES = ('kernel', 'fit', 'mean', 'variance', 'sample')
+
+
+def _exact(kernel, noise, dtype):
+    return gp.GaussianProcessRegressor(kernel=kernel, noise=noise, dtype=dtype)
+
+
+def _iterative(kernel, noise, dtype):
+    from gp_iterative import IterativeGaussianProcessRegressor
+    return IterativeGaussianProcessRegressor(kernel=kernel, noise=noise, random_state=0)
+
+
+def _sparse(kernel, noise, dtype):
+    from gp_sparse import SparseGaussianProcessRegressor
+    return SparseGaussianProcessRegressor(kernel=kernel, noise=noise, random_state=0)
+
+
+def _compact(kernel, noise, dtype):
+    from gp_compact import CompactGaussianProcessRegressor, Wendland
+    return CompactGaussianProcessRegressor(kernel=Wendland(support=2.0), noise=noise)
+
+
+# - Backend name -> factory(kernel, noise, dtype). Only the exact backend
+# - supports reduced precision, other combinations are skipped.
+BACKENDS = {
+    'exact': _exact,
+    'iterative': _iterative,
+    'sparse': _sparse,
+    'compact': _compact,
+}
+
+
+def make_data(N, n, dim, noise=0.01, random_state=None):
+    """Noisy samples of a sum of sines on [-5, 5]^dim and a test set."""
+
+    rng = np.random.default_rng(random_state)
+
+    X = rng.uniform(-5, 5, size=(N, dim))
+    y = np.sin(0.9*X).sum(1) + np.sqrt(noise)*rng.standard_normal(N)
+    Xtest = rng.uniform(-5, 5, size=(n, dim))
+
+    return X, y, Xtest
+
+
+def measure(func, repeat=3, trace_memory=True):
+    """Run func() repeat times. Returns (result of the last run, record with
+       best and mean seconds and peak traced bytes)."""
+
+    times = []
+    peak = 0
+
+    for _ in range(repeat):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+        if trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    record = {'best_seconds': min(times), 'mean_seconds': float(np.mean(times)),
+              'peak_bytes': peak if trace_memory else None}
+
+    return result, record
+
+
+def run_case(backend, N, n, dim, dtype='float64', n_samples=10, noise=0.01, repeat=3,
+             trace_memory=True, max_kernel_bytes=2**30, sample_method=None, random_state=0):
+    """Benchmark one configuration, returns one record per phase."""
+
+    X, y, Xtest = make_data(N, n, dim, noise, random_state)
+    kernel = gp.SquaredExponential(length_scale=1.0)
+    model = BACKENDS[backend](kernel, noise, dtype)
+
+    # - Warm up, so that the lazy scipy imports are not timed
+    BACKENDS[backend](kernel, noise, dtype).fit(X[:10], y[:10]).predict(Xtest[:10], return_var=True)
+
+    # - Exact posterior samples need an n x n factorisation, use pathwise
+    # - sampling for large test sets when the kernel supports it
+    skipped = {}
+    if sample_method is None:
+        if n <= 2000:
+            sample_method = 'cholesky'
+        elif hasattr(model.kernel, 'sample_frequencies'):
+            sample_method = 'pathwise'
+        else:
+            skipped['sample'] = 'n > 2000 and the kernel has no sample_frequencies() for pathwise sampling'
+
+    phases = {
+        'kernel': lambda: gp_tiles.kernel_matrix(model.kernel, X, X, model.max_bytes, dtype=dtype),
+        'fit': lambda: model.fit(X, y),
+        'mean': lambda: model.predict(Xtest),
+        'variance': lambda: model.predict(Xtest, return_var=True),
+        'sample': lambda: model.sample_posterior(Xtest, n_samples, random_state=random_state,
+                                                 method=sample_method),
+    }
+    if N*N*np.dtype(dtype).itemsize > max_kernel_bytes:
+        del phases['kernel']
+
+    records = []
+    for phase in PHASES:
+        if phase not in phases:
+            continue
+        case = dict(backend=backend, dtype=np.dtype(dtype).name, N=N, n=n, dim=dim,
+                    phase=phase, repeat=repeat)
+        if phase in skipped:
+            records.append(dict(case, skipped=skipped[phase]))
+            continue
+        try:
+            _, record = measure(phases[phase], repeat, trace_memory)
+        except Exception as error:
+            # - tracemalloc may still be running after a failure inside measure()
+            tracemalloc.stop()
+            records.append(dict(case, skipped='{}: {}'.format(type(error).__name__, error)))
+            continue
+        records.append(dict(case, **record))
+
+    return records
+
+
+def sweep(N=(500, 2000), n=(1000,), dim=(1,), dtype=('float64',), backend=('exact',),
+          verbose=True, **kwargs):
+    """Run run_case() over the product of the given sizes, dtypes and backends.
+
+       Reduced precision is only benchmarked for the exact backend. Keyword
+       arguments are passed to run_case()."""
+
+    results = []
+    for name in backend:
+        for dt in dtype:
+            if name != 'exact' and np.dtype(dt) != np.float64:
+                continue
+            for d in dim:
+                for N_ in N:
+                    for n_ in n:
+                        records = run_case(name, N_, n_, d, dt, **kwargs)
+                        results.extend(records)
+                        if verbose:
+                            print(' '.join('{}={}'.format(key, records[0][key])
+                                           for key in ('backend', 'dtype', 'N', 'n', 'dim')))
+                            for record in records:
+                                if 'skipped' in record:
+                                    print('    {phase:10s} skipped: {skipped}'.format(**record))
+                                else:
+                                    print('    {phase:10s} {best_seconds:10.4f} s {peak_bytes} B'.format(**record))
+
+    return results
+
+
+# - Resident set size of the running interpreter in bytes. getrusage() is only
+# - a fallback: on Linux a child's ru_maxrss includes its parent's at fork time.
+_RSS_CODE = """
+try:
+    with open('/proc/self/status') as f:
+        rss = 1024*int([line.split()[1] for line in f if line.startswith('VmRSS:')][0])
+except OSError:
+    import resource, sys
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss if sys.platform == 'darwin' else 1024*rss
+print(rss)
+"""
+
+
+def import_cost(module='gp', python=sys.executable):
+    """Import time and memory of module, measured in a fresh interpreter.
+
+       Returns a record with the cumulative import time reported by
+       -X importtime and the resident set size of the interpreter after the
+       import, and of a bare interpreter for reference (in bytes)."""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([python, '-X', 'importtime', '-c', 'import {}\n'.format(module) + _RSS_CODE],
+                          cwd=here, capture_output=True, text=True, check=True)
+    baseline = subprocess.run([python, '-c', _RSS_CODE], capture_output=True, text=True, check=True)
+
+    # - Lines look like 'import time: self [us] | cumulative | imported package'
+    seconds = None
+    for line in proc.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            seconds = int(fields[1]) * 1e-6
+
+    return {'module': module, 'import_seconds': seconds,
+            'rss_bytes': int(proc.stdout.split()[-1]),
+            'baseline_rss_bytes': int(baseline.stdout.split()[-1])}
+
+
+def write_json(results, path, **meta):
+    """Write benchmark records, with extra metadata, as JSON."""
+
+    with open(path, 'w') as f:
+        json.dump({'meta': dict(python=sys.version, numpy=np.__version__, **meta),
+                   'results': results}, f, indent=2)
+
+
+def write_csv(results, path):
+    """Write benchmark records as CSV, one row per configuration and phase."""
+
+    fields = []
+    for record in results:
+        fields.extend(key for key in record if key not in fields)
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--N', type=int, nargs='+', default=[500, 2000], help='training sizes')
+    parser.add_argument('--n', type=int, nargs='+', default=[1000], help='test sizes')
+    parser.add_argument('--dim', type=int, nargs='+', default=[1], help='input dimensions')
+    parser.add_argument('--dtype', nargs='+', default=['float64'], help='float64 and/or float32')
+    parser.add_argument('--backend', nargs='+', default=['exact'], choices=sorted(BACKENDS))
+    parser.add_argument('--samples', type=int, default=10, help='posterior samples')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='disable tracemalloc')
+    parser.add_argument('--json', help='write the results as JSON')
+    parser.add_argument('--csv', help='write the results as CSV')
+    args = parser.parse_args(argv)
+
+    imports = import_cost()
+    print('import gp: {import_seconds:.4f} s, RSS {rss_bytes} B '
+          '(bare interpreter {baseline_rss_bytes} B)'.format(**imports))
+
+    results = sweep(args.N, args.n, args.dim, args.dtype, args.backend, n_samples=args.samples,
+                    repeat=args.repeat, trace_memory=not args.no_memory)
+
+    if args.json:
+        write_json(results, args.json, import_cost=imports)
+    if args.csv:
+        write_csv(results, args.csv)
+
+
+if __name__ == '__main__':
+    main()
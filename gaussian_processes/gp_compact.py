@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Compactly supported kernels and sparse GP inference for large spatial data.
+
+A Wendland kernel is exactly zero beyond its support radius, so K only has
+entries for pairs of points closer than the support. These pairs are found
+with a KD-tree and K is assembled directly as a scipy sparse matrix, so
+memory and time scale with the number of neighbouring pairs instead of N^2.
+
+K + noise*I is factorised with SuperLU using a symmetric minimum degree
+(fill-reducing) ordering and no pivoting. For a symmetric positive definite
+matrix this is the sparse Cholesky factorisation in LDL^T form (scipy has no
+dedicated sparse Cholesky), and it provides the solves and the log-determinant.
+"""
+
+import numpy as np
+
+import gp
+import gp_tiles
+
+
+# - Wendland functions phi_{3,k}(r) for r = distance / support < 1, positive
+# - definite in up to three input dimensions and 2k times differentiable
+WENDLAND = {
+    0: lambda r: (1 - r)**2,
+    1: lambda r: (1 - r)**4 * (4*r + 1),
+    2: lambda r: (1 - r)**6 * (35*r**2 + 18*r + 3) / 3,
+    3: lambda r: (1 - r)**8 * (32*r**3 + 25*r**2 + 8*r + 1),
+}
+
+
+class Wendland:
+    """ Compactly supported Wendland kernel
+
+        k(a, b) = variance * phi_{3,smoothness}(|a - b| / support)
+
+        Besides the dense kernel interface (see gp.SquaredExponential) it
+        provides sparse(a, b), the kernel matrix as a scipy sparse matrix built
+        from the pairs within the support radius."""
+
+    stationary = True
+
+    def __init__(self, support=1.0, variance=1.0, smoothness=1):
+        if smoothness not in WENDLAND:
+            raise ValueError("Wendland smoothness must be one of {}".format(sorted(WENDLAND)))
+
+        self.support = support
+        self.variance = variance
+        self.smoothness = smoothness
+
+    def _phi(self, d):
+        r = np.minimum(d / self.support, 1.0)
+        return self.variance * WENDLAND[self.smoothness](r)
+
+    def __call__(self, a, b, out=None):
+        sqdist = np.dot(a, b.T, out=out)
+        sqdist *= -2
+        sqdist += np.sum(a**2,1).reshape(-1,1)
+        sqdist += np.sum(b**2,1)
+        np.maximum(sqdist, 0.0, out=sqdist)
+        np.sqrt(sqdist, out=sqdist)
+        sqdist[...] = self._phi(sqdist)
+        return sqdist
+
+    def diag(self, a):
+        return np.full(len(a), float(self.variance))
+
+    def sparse(self, a, b, tree_b=None):
+        """Sparse len(a) x len(b) kernel matrix (CSR) from a KD-tree neighbour
+           search. A prebuilt cKDTree of b can be passed in."""
+        from scipy.sparse import csr_matrix
+        from scipy.spatial import cKDTree
+
+        if tree_b is None:
+            tree_b = cKDTree(b)
+
+        pairs = cKDTree(a).sparse_distance_matrix(tree_b, self.support, output_type='ndarray')
+
+        return csr_matrix((self._phi(pairs['v']), (pairs['i'], pairs['j'])), shape=(len(a), len(b)))
+
+
+class CompactGaussianProcessRegressor(gp.GaussianProcessRegressor):
+    """GP regression with a compactly supported kernel and a sparse factorisation.
+
+       The kernel must provide sparse(a, b) (e.g. Wendland). After fit() the
+       model stores the sparse factorisation of K + noise*I in factor; only
+       X_train, y_train and alpha are persisted, restore() refactorises.
+       """
+
+    fitted_arrays = ('X_train', 'y_train', 'alpha')
+
+    def __init__(self, kernel=None, noise=0.00005, jitter=1e-6,
+                 max_bytes=gp_tiles.DEFAULT_MAX_BYTES):
+        super().__init__(kernel=kernel if kernel is not None else Wendland(),
+                         noise=noise, jitter=jitter, max_bytes=max_bytes)
+
+    def restore(self):
+        """Assemble the sparse K + noise*I and factorise it."""
+        from scipy.sparse import identity
+        from scipy.sparse.linalg import splu
+        from scipy.spatial import cKDTree
+
+        self.tree = cKDTree(self.X_train)
+        K = self.kernel.sparse(self.X_train, self.X_train, self.tree)
+        K = (K + self.noise*identity(len(self.X_train))).tocsc()
+
+        self.nnz = K.nnz
+        self.factor = splu(K, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.0,
+                           options=dict(SymmetricMode=True))
+
+        return self
+
+    def fit(self, X, y):
+        """Sparse factorisation of K + noise*I and weights alpha."""
+
+        self.X_train = np.atleast_2d(np.asarray(X, dtype=float))
+        self.y_train = np.asarray(y, dtype=float)
+        self.restore()
+
+        self.alpha = self.solve(self.y_train)
+
+        return self
+
+    def solve(self, b):
+        """Solve (K + noise*I) x = b with the sparse factorisation."""
+        return self.factor.solve(np.asarray(b, dtype=float))
+
+    def log_marginal_likelihood(self):
+        """Log marginal likelihood, log det from the diagonal of the sparse factor."""
+
+        logdet = np.sum(np.log(np.abs(self.factor.U.diagonal())))
+
+        N = len(self.y_train)
+        return (-0.5*np.einsum('i...,i...->...', self.y_train, self.alpha)
+                - 0.5*logdet - 0.5*N*np.log(2*np.pi))
+
+    def _predict_cov(self, Xtest):
+        Ks = self.kernel.sparse(Xtest, self.X_train, self.tree)
+        mu = Ks @ self.alpha
+        cov = gp_tiles.kernel_matrix(self.kernel, Xtest, Xtest, self.max_bytes)
+        cov -= Ks @ self.solve(Ks.T.toarray())
+
+        return mu, cov
+
+    def predict_tiles(self, Xtest, return_std=False, return_var=False):
+        """Stream predictions for consecutive blocks of test points. The test x
+           train kernel block is sparse; the variance needs one solve per tile."""
+
+        Xtest = np.atleast_2d(np.asarray(Xtest, dtype=float))
+        size = gp_tiles.tile_rows(len(self.X_train), self.max_bytes)
+
+        for rows in gp_tiles.iter_slices(len(Xtest), size):
+            Ks = self.kernel.sparse(Xtest[rows], self.X_train, self.tree)
+            mu = Ks @ self.alpha
+
+            if not (return_std or return_var):
+                yield rows, mu, None
+                continue
+
+            Kt = Ks.T.toarray()
+            s2 = self.kernel.diag(Xtest[rows]) - np.einsum('ij,ij->j', Kt, self.solve(Kt))
+            np.maximum(s2, 0.0, out=s2)
+
+            yield rows, mu, (np.sqrt(s2) if return_std else s2)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+Structured GP inference on regular grids.
+
+For a stationary product kernel (the squared exponential factorises over
+input dimensions) evaluated on a regular grid U = U_1 x ... x U_D:
+- every 1-D factor K_d = k_d(U_d, U_d) is a symmetric Toeplitz matrix, whose
+  matrix-vector products cost O(m log m) through a circulant embedding and FFT
+- K_UU = K_1 (x) ... (x) K_D is a Kronecker product, applied axis by axis to
+  the grid-shaped vector, and its eigendecomposition is the Kronecker product
+  of the (small) 1-D eigendecompositions.
+
+fit_grid(y) uses the Kronecker eigendecomposition when the observations cover
+the whole grid, which makes exact inference O(M sum_d m_d) for M grid points.
+
+fit(X, y) handles off-grid training points with structured kernel
+interpolation (KISS-GP): K_XX ~ W K_UU W^T, where W holds local cubic
+interpolation weights (4^D non-zeros per row). The system is solved by CG
+with O(N 4^D + M log M) matrix-vector products and the predictive mean is
+an interpolation of precomputed grid values, O(4^D) per test point.
+"""
+
+import numpy as np
+
+import gp
+import gp_iterative
+import gp_tiles
+
+
+###########################
+## -- Grid primitives -- ##
+###########################
+
+def regular_axis(axis):
+    """Start and spacing of a uniformly spaced 1-D axis."""
+
+    axis = np.asarray(axis, dtype=float)
+    if len(axis) < 2:
+        return axis[0], 1.0
+
+    step = (axis[-1] - axis[0]) / (len(axis) - 1)
+    if not np.allclose(np.diff(axis), step, rtol=1e-6, atol=0):
+        raise ValueError("Grid axes must be uniformly spaced")
+
+    return axis[0], step
+
+
+def grid_points(axes):
+    """All points of the grid axes[0] x ... x axes[D-1], in C order (M x D)."""
+    mesh = np.meshgrid(*axes, indexing='ij')
+    return np.stack([m.ravel() for m in mesh], axis=1)
+
+
+def toeplitz_eigenvalues(column):
+    """FFT of the circulant embedding of a symmetric Toeplitz matrix."""
+    column = np.asarray(column, dtype=float)
+    if len(column) < 2:
+        return column
+    return np.fft.rfft(np.concatenate([column, column[-2:0:-1]])).real
+
+
+def toeplitz_matvec(eigenvalues, m, V, axis=0):
+    """Product of the m x m symmetric Toeplitz matrix, given by its circulant
+       eigenvalues, with V along axis. O(m log m) per vector."""
+
+    if m < 2:
+        return V * eigenvalues[0]
+
+    n = 2*m - 2
+    shape = [1]*V.ndim
+    shape[axis] = len(eigenvalues)
+
+    F = np.fft.rfft(V, n=n, axis=axis)
+    F *= eigenvalues.reshape(shape)
+    return np.take(np.fft.irfft(F, n=n, axis=axis), np.arange(m), axis=axis)
+
+
+def apply_along_axis(A, V, axis):
+    """Product of a dense or sparse matrix A with V along the given axis."""
+
+    V = np.moveaxis(V, axis, 0)
+    shape = V.shape
+    AV = A @ V.reshape(shape[0], -1)
+    return np.moveaxis(np.asarray(AV).reshape((A.shape[0],) + shape[1:]), 0, axis)
+
+
+def cubic_weights(t):
+    """Keys cubic convolution weights of the nodes i-1, i, i+1, i+2 for a point
+       at fractional position t in [0, 1) past node i."""
+
+    a = -0.5
+    d = np.stack([1 + t, t, 1 - t, 2 - t], axis=-1)
+    near = (a + 2)*d**3 - (a + 3)*d**2 + 1
+    far = a*d**3 - 5*a*d**2 + 8*a*d - 4*a
+    return np.where(d <= 1, near, far)
+
+
+def interpolation_matrix(X, axes):
+    """Sparse N x M matrix of cubic interpolation weights from the grid to X.
+
+       Points closer than two cells to the grid boundary have their weights
+       clipped onto the boundary nodes."""
+    from scipy.sparse import csr_matrix
+
+    N, D = X.shape
+    shape = tuple(len(axis) for axis in axes)
+
+    index, weight = [], []
+    for d, axis in enumerate(axes):
+        start, step = regular_axis(axis)
+        s = (X[:,d] - start) / step
+        i = np.floor(s)
+        index.append(np.clip(i[:,None].astype(int) + np.arange(-1, 3), 0, shape[d] - 1))
+        weight.append(cubic_weights(s - i))
+
+    # - Tensor product of the 1-D stencils: 4^D entries per row
+    rows = np.repeat(np.arange(N), 4**D)
+    cols = np.zeros((N, 1), dtype=int)
+    vals = np.ones((N, 1))
+    for d in range(D):
+        cols = (cols[:,:,None]*shape[d] + index[d][:,None,:]).reshape(N, -1)
+        vals = (vals[:,:,None]*weight[d][:,None,:]).reshape(N, -1)
+
+    return csr_matrix((vals.ravel(), (rows, cols.ravel())), shape=(N, int(np.prod(shape))))
+
+
+############################
+## -- Gaussian process -- ##
+############################
+
+class GridGaussianProcessRegressor(gp.GaussianProcessRegressor):
+    """GP regression with a squared exponential kernel on a regular grid.
+
+       Inputs, in addition to GaussianProcessRegressor:
+       - grid: list of D uniformly spaced 1-D axes. If None, fit() builds one
+         with grid_size points per dimension covering the training inputs.
+       - grid_size: number of grid points per dimension of the automatic grid
+       - tol, maxiter: CG settings of the interpolated (off-grid) fit
+       - n_probes, lanczos_steps, random_state: SLQ settings of the
+         interpolated log marginal likelihood
+       """
+
+    fitted_arrays = ('X_train', 'y_train', 'alpha', 'u', 'axis_start', 'axis_step',
+                     'axis_size', 'exact')
+
+    def __init__(self, kernel=gp.kernel, noise=0.00005, jitter=1e-6,
+                 max_bytes=gp_tiles.DEFAULT_MAX_BYTES, grid=None, grid_size=100,
+                 tol=1e-6, maxiter=1000, n_probes=16, lanczos_steps=30, random_state=None):
+        super().__init__(kernel=kernel, noise=noise, jitter=jitter, max_bytes=max_bytes)
+        self.grid = grid
+        self.grid_size = grid_size
+        self.tol = tol
+        self.maxiter = maxiter
+        self.n_probes = n_probes
+        self.lanczos_steps = lanczos_steps
+        self.random_state = random_state
+
+    ## -- Kernel structure -- ##
+
+    def _setup_grid(self, axes):
+        self.axes = [np.asarray(axis, dtype=float) for axis in axes]
+        self.shape = tuple(len(axis) for axis in self.axes)
+
+        start, step = zip(*[regular_axis(axis) for axis in self.axes])
+        self.axis_start = np.array(start)
+        self.axis_step = np.array(step)
+        self.axis_size = np.array(self.shape)
+
+    def restore(self):
+        """Rebuild the per-axis kernels, eigendecompositions and the
+           interpolation matrix from the stored grid description."""
+
+        self.axes = [start + step*np.arange(size) for start, step, size
+                     in zip(self.axis_start, self.axis_step, self.axis_size)]
+        self.shape = tuple(int(size) for size in self.axis_size)
+
+        length_scale = np.broadcast_to(self.kernel.length_scale, (len(self.axes),))
+        self.axis_kernels = [gp.SquaredExponential(length_scale=l) for l in length_scale]
+        self.axis_eigenvalues = [toeplitz_eigenvalues(k(axis[:1,None], axis[:,None])[0])
+                                 for k, axis in zip(self.axis_kernels, self.axes)]
+
+        if self.exact:
+            # - Kronecker eigendecomposition, Lambda = variance * lambda_1 (x) ... (x) lambda_D
+            self.axis_eig = []
+            lam = np.array(self.kernel.variance)
+            for k, axis in zip(self.axis_kernels, self.axes):
+                w, Q = np.linalg.eigh(k(axis[:,None], axis[:,None]))
+                self.axis_eig.append(Q)
+                lam = np.multiply.outer(lam, np.maximum(w, 0.0))
+            self.lam = lam
+            self.W = None
+        else:
+            self.W = interpolation_matrix(self.X_train, self.axes)
+
+        self._logdet = None
+
+        return self
+
+    def kuu_matvec(self, V):
+        """K_UU V for a grid-shaped V (optionally with trailing output axes)."""
+        for d, (eigenvalues, m) in enumerate(zip(self.axis_eigenvalues, self.shape)):
+            V = toeplitz_matvec(eigenvalues, m, V, axis=d)
+        return self.kernel.variance * V
+
+    def _grid(self, v):
+        return v.reshape(self.shape + v.shape[1:])
+
+    def _flat(self, V):
+        return V.reshape((-1,) + V.shape[len(self.shape):])
+
+    ## -- Fitting -- ##
+
+    def fit_grid(self, y, grid=None):
+        """Exact inference for observations y at every point of the grid (in C
+           order of the axes, flat or grid-shaped), using the Kronecker
+           eigendecomposition."""
+
+        self._setup_grid(grid if grid is not None else self.grid)
+        self.exact = True
+
+        y = np.asarray(y, dtype=float)
+        if y.ndim > 1 and y.shape[:len(self.shape)] == self.shape:
+            y = self._flat(y)
+
+        self.X_train = grid_points(self.axes)
+        self.y_train = y
+        self.restore()
+
+        self.alpha = self.solve(y)
+
+        # - Grid values of the posterior mean, u = K alpha = y - noise*alpha
+        self.u = y - self.noise*self.alpha
+
+        return self
+
+    def fit(self, X, y):
+        """Structured kernel interpolation fit for arbitrary training inputs."""
+
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        y = np.asarray(y, dtype=float)
+
+        if self.grid is not None:
+            axes = self.grid
+        else:
+            # - Pad by two cells so that the cubic stencils stay inside the grid
+            low, high = X.min(axis=0), X.max(axis=0)
+            step = (high - low) / max(self.grid_size - 5, 1)
+            step[step == 0] = 1.0
+            axes = [l - 2*h + h*np.arange(self.grid_size) for l, h in zip(low, step)]
+
+        self._setup_grid(axes)
+        self.exact = False
+
+        self.X_train = X
+        self.y_train = y
+        self.restore()
+
+        self.alpha = self.solve(y)
+        self.u = self._flat(self.kuu_matvec(self._grid(self.W.T @ self.alpha)))
+
+        return self
+
+    def matvec(self, v):
+        """(W K_UU W^T + noise*I) v, the interpolated training kernel product."""
+        return self.W @ self._flat(self.kuu_matvec(self._grid(self.W.T @ v))) + self.noise*v
+
+    def solve(self, b):
+        """Solve (K + noise*I) x = b in the structured representation."""
+
+        if not self.exact:
+            x, self.n_iter, self.residual = gp_iterative.conjugate_gradient(
+                self.matvec, b, tol=self.tol, maxiter=self.maxiter)
+            return x
+
+        # - (K + noise*I)^-1 b = Q (Lambda + noise)^-1 Q^T b
+        V = self._grid(b)
+        for d, Q in enumerate(self.axis_eig):
+            V = apply_along_axis(Q.T, V, d)
+        V = V / (self.lam + self.noise).reshape(self.shape + (1,)*(V.ndim - len(self.shape)))
+        for d, Q in enumerate(self.axis_eig):
+            V = apply_along_axis(Q, V, d)
+        return self._flat(V)
+
+    def log_marginal_likelihood(self):
+        """Exact for fit_grid(), SLQ estimate for the interpolated fit."""
+
+        if self.exact:
+            logdet = np.sum(np.log(self.lam + self.noise))
+        else:
+            if self._logdet is None:
+                self._logdet = gp_iterative.lanczos_logdet(self.matvec, len(self.X_train), self.n_probes,
+                                                           self.lanczos_steps, self.random_state)
+            logdet = self._logdet
+
+        N = len(self.y_train)
+        return (-0.5*np.einsum('i...,i...->...', self.y_train, self.alpha)
+                - 0.5*logdet - 0.5*N*np.log(2*np.pi))
+
+    ## -- Prediction -- ##
+
+    def _cross_factors(self, axes):
+        """Per-axis cross-kernel matrices k_d(axes[d], U_d), n_d x m_d."""
+        return [k(axis[:,None], U[:,None]) for k, axis, U in zip(self.axis_kernels, axes, self.axes)]
+
+    def _contract(self, factors, G):
+        """sum_i prod_d F_d[j, i_d] G[i, ...] for every row j of the factors,
+           i.e. separable (Kronecker) rows applied to the grid-shaped G."""
+
+        D = len(factors)
+        G = np.moveaxis(G, tuple(range(D)), tuple(range(G.ndim - D, G.ndim)))
+        out = np.tensordot(G, factors[-1], axes=([G.ndim - 1], [1]))
+        for F in factors[-2::-1]:
+            out = np.einsum('...ij,ji->...j', out, F)
+        return np.moveaxis(out, -1, 0)
+
+    def _kron(self, factors, G):
+        """(F_1 (x) ... (x) F_D) G for the grid-shaped G."""
+        for d, F in enumerate(factors):
+            G = apply_along_axis(F, G, d)
+        return G
+
+    def predict_tiles(self, Xtest, return_std=False, return_var=False):
+        """Stream predictions for consecutive blocks of test points.
+
+           After fit_grid() mean and variance are exact and cost O(M) per test
+           point. After the interpolated fit the mean is interpolated from the
+           grid values, O(4^D) per point, and the variance needs a CG solve per
+           tile."""
+
+        Xtest = np.atleast_2d(np.asarray(Xtest, dtype=float))
+        M = int(np.prod(self.shape))
+        size = gp_tiles.tile_rows(M, self.max_bytes)
+
+        for rows in gp_tiles.iter_slices(len(Xtest), size):
+            with_var = return_std or return_var
+
+            if self.exact:
+                factors = self._cross_factors(Xtest[rows].T)
+                mu = self.kernel.variance * self._contract(factors, self._grid(self.alpha))
+
+                if with_var:
+                    # - var = variance - variance^2 sum_i (k_d^T Q_d)^2 / (Lambda_i + noise)
+                    A = [np.dot(F, Q)**2 for F, Q in zip(factors, self.axis_eig)]
+                    quad = self._contract(A, 1.0 / (self.lam + self.noise))
+                    s2 = np.maximum(self.kernel.variance - self.kernel.variance**2 * quad, 0.0)
+            else:
+                Ws = interpolation_matrix(Xtest[rows], self.axes)
+                mu = Ws @ self.u
+
+                if with_var:
+                    # - k(X, x*) ~ W K_UU Ws^T
+                    Kxs = self.W @ self._flat(self.kuu_matvec(self._grid(Ws.T.toarray())))
+                    s2 = self.kernel.diag(Xtest[rows]) - np.einsum('ij,ij->j', Kxs, self.solve(Kxs))
+                    np.maximum(s2, 0.0, out=s2)
+
+            if not with_var:
+                yield rows, mu, None
+            else:
+                yield rows, mu, (np.sqrt(s2) if return_std else s2)
+
+    def predict_grid(self, axes, return_std=False, return_var=False):
+        """Predictions at every point of the regular test grid axes[0] x ...,
+           returned with the grid shape. Uses Kronecker products of the 1-D
+           cross-kernels, so the cost is near-linear in the test grid size."""
+
+        factors = self._cross_factors([np.asarray(axis, dtype=float) for axis in axes])
+
+        # - mu = variance * (K*_1 (x) ... (x) K*_D) W^T alpha
+        beta = self.alpha if self.W is None else self.W.T @ self.alpha
+        mu = self.kernel.variance * self._kron(factors, self._grid(beta))
+
+        if not (return_std or return_var):
+            return mu
+
+        if not self.exact:
+            raise ValueError("Grid variances need observations on the whole grid (fit_grid)")
+
+        A = [np.dot(F, Q)**2 for F, Q in zip(factors, self.axis_eig)]
+        quad = self._kron(A, 1.0 / (self.lam + self.noise))
+        s2 = np.maximum(self.kernel.variance - self.kernel.variance**2 * quad, 0.0)
+
+        return mu, (np.sqrt(s2) if return_std else s2)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Save and load fitted GP models.
+
+A model is stored as a directory:
+
+    model/
+        meta.json       format version, model and kernel classes and parameters
+        X_train.npy     one .npy file per fitted array (see fitted_arrays)
+        L.npy
+        alpha.npy
+        ...
+
+The arrays are opened with np.load(mmap_mode='r') by default, so loading is
+almost free and many worker processes serving the same model share a single
+copy through the page cache. Arrays are written in the memory order used by
+the prediction code (e.g. the Fortran ordered Cholesky factor), so no copies
+are made when predicting from a memory-mapped model.
+"""
+
+import importlib
+import inspect
+import json
+import os
+import types
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+
+
+def _get_params(obj):
+    """Constructor arguments of obj, read back from its attributes."""
+    names = [name for name in inspect.signature(type(obj).__init__).parameters if name != 'self']
+    return {name: getattr(obj, name) for name in names}
+
+
+def _encode_function(function):
+    """Reference to a module-level function by module and qualified name."""
+
+    qualname = getattr(function, '__qualname__', '')
+    module = getattr(function, '__module__', None)
+    if module is None or '<' in qualname:
+        raise TypeError("Cannot save the function {!r}: only module-level functions and kernel "
+                        "objects can be serialised, not lambdas or nested functions".format(function))
+
+    return {'function': qualname, 'module': module}
+
+
+def _decode_function(description):
+    obj = importlib.import_module(description['module'])
+    for name in description['function'].split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _encode(obj, path, prefix):
+    """JSON description of an object's class and parameters. Array valued
+       parameters are written to separate .npy files, nested objects (e.g.
+       kernels) are encoded recursively and functions by their qualified name."""
+
+    params = {}
+    for name, value in _get_params(obj).items():
+        if isinstance(value, (types.FunctionType, types.BuiltinFunctionType, np.ufunc)):
+            params[name] = _encode_function(value)
+        elif isinstance(value, np.ndarray):
+            filename = '{}{}.npy'.format(prefix, name)
+            np.save(os.path.join(path, filename), value)
+            params[name] = {'array': filename}
+        elif hasattr(value, '__dict__') and not isinstance(value, np.random.Generator):
+            params[name] = _encode(value, path, prefix + name + '.')
+        elif isinstance(value, np.random.Generator):
+            params[name] = None
+        elif isinstance(value, np.dtype):
+            params[name] = value.name
+        elif isinstance(value, np.generic):
+            params[name] = value.item()
+        elif isinstance(value, (list, tuple)):
+            params[name] = [np.asarray(item).tolist() for item in value]
+        else:
+            params[name] = value
+
+    return {'module': type(obj).__module__, 'class': type(obj).__name__, 'params': params}
+
+
+def _decode(description, path, mmap_mode):
+    """Rebuild an object from its _encode() description."""
+
+    params = {}
+    for name, value in description['params'].items():
+        if isinstance(value, dict) and 'array' in value:
+            params[name] = np.load(os.path.join(path, value['array']), mmap_mode=mmap_mode)
+        elif isinstance(value, dict) and 'class' in value:
+            params[name] = _decode(value, path, mmap_mode)
+        elif isinstance(value, dict) and 'function' in value:
+            params[name] = _decode_function(value)
+        else:
+            params[name] = value
+
+    cls = getattr(importlib.import_module(description['module']), description['class'])
+    return cls(**params)
+
+
+def save(model, path):
+    """Write a fitted model to the directory path."""
+
+    os.makedirs(path, exist_ok=True)
+
+    meta = {'format_version': FORMAT_VERSION,
+            'model': _encode(model, path, 'param.'),
+            'arrays': [],
+            'scalars': {}}
+
+    for name in model.fitted_arrays:
+        value = getattr(model, name)
+        if np.ndim(value) == 0:
+            meta['scalars'][name] = float(value)
+        else:
+            np.save(os.path.join(path, name + '.npy'), value)
+            meta['arrays'].append(name)
+
+    # - meta.json is written last, so a directory without it is an incomplete save
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def load(path, mmap_mode='r'):
+    """Load a model written by save(). With mmap_mode=None the arrays are read
+       into memory instead of being memory-mapped."""
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    if meta['format_version'] > FORMAT_VERSION:
+        raise ValueError("Model format version {} is newer than the supported version {}".format(
+            meta['format_version'], FORMAT_VERSION))
+
+    model = _decode(meta['model'], path, mmap_mode)
+
+    for name in meta['arrays']:
+        setattr(model, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+    for name, value in meta['scalars'].items():
+        setattr(model, name, value)
+
+    return model.restore()
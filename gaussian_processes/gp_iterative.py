@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""
+Matrix-free GP inference.
+
+Instead of factorising K + noise*I, the linear systems are solved with
+preconditioned conjugate gradients (CG) that only need products
+(K + noise*I) v. These are computed in tiles by gp_tiles.kernel_matvec, so K
+is never stored and memory is O(N) plus one tile. The log-determinant needed
+by the marginal likelihood is estimated by stochastic Lanczos quadrature (SLQ).
+
+The preconditioner is a rank-k pivoted Cholesky approximation K ~ U U^T,
+which only needs the kernel diagonal and k rows of K.
+
+log_marginal_likelihood() is the matrix-free counterpart of
+gp_optimize.log_marginal_likelihood for hyperparameter learning: the value
+uses the SLQ log-determinant, and the gradient
+
+    d log p(y) / d theta_i = 0.5 alpha^T dK_i alpha - 0.5 tr(K^-1 dK_i)
+
+estimates the trace with the Rademacher probes z of the SLQ estimate,
+tr(K^-1 dK_i) ~ mean_z (K^-1 z)^T dK_i z. alpha and all K^-1 z come from
+one block CG solve, and the products with dK_i from the kernel's
+gradient_quadform(). The probes are fixed by the seed, so the objective is
+deterministic for the optimiser.
+"""
+
+import warnings
+
+import numpy as np
+
+import gp
+import gp_tiles
+
+
+##########################
+## -- Linear algebra -- ##
+##########################
+
+def conjugate_gradient(matvec, b, precond=None, tol=1e-6, maxiter=1000):
+    """Solve A x = b for a symmetric positive definite A given only matvec(v) = A v.
+
+       b can be a vector or an N x T matrix whose columns are solved together.
+       Iterations stop when every column reaches ||r|| <= tol ||b|| or after
+       maxiter steps. Returns (x, iterations, relative residuals)."""
+
+    shape = b.shape
+    b = b.reshape(len(b), -1)
+
+    x = np.zeros_like(b)
+    r = b.copy()
+    z = precond(r) if precond is not None else r.copy()
+    p = z.copy()
+    rz = np.einsum('ij,ij->j', r, z)
+
+    bnorm = np.linalg.norm(b, axis=0)
+    bnorm[bnorm == 0] = 1.0
+
+    for iteration in range(maxiter):
+        residual = np.linalg.norm(r, axis=0) / bnorm
+        active = residual > tol
+        if not active.any():
+            break
+
+        Ap = matvec(p)
+        pAp = np.einsum('ij,ij->j', p, Ap)
+        a = np.where(active, rz / np.where(pAp == 0, 1.0, pAp), 0.0)
+
+        x += a*p
+        r -= a*Ap
+
+        z = precond(r) if precond is not None else r.copy()
+        rz_new = np.einsum('ij,ij->j', r, z)
+        beta = np.where(active, rz_new / np.where(rz == 0, 1.0, rz), 0.0)
+        p *= beta
+        p += z
+        rz = rz_new
+    else:
+        residual = np.linalg.norm(r, axis=0) / bnorm
+        if (residual > tol).any():
+            warnings.warn("CG did not converge in {} iterations, relative residual {:.2e}".format(
+                maxiter, residual.max()))
+
+    return x.reshape(shape), iteration, residual
+
+
+def pivoted_cholesky(kernel, X, rank, tol=1e-10):
+    """Rank-k partial pivoted Cholesky factor U (N x k) with K(X, X) ~ U U^T.
+
+       Needs the kernel diagonal and k rows of K, O(N k^2) in total."""
+
+    N = len(X)
+    d = np.array(gp_tiles.kernel_diag(kernel, X), dtype=float)
+    U = np.zeros((min(rank, N), N))
+
+    for m in range(len(U)):
+        i = np.argmax(d)
+        if d[i] <= tol:
+            U = U[:m]
+            break
+
+        row = gp_tiles.evaluate(kernel, X[i:i+1], X)[0]
+        U[m] = (row - np.dot(U[:m,i], U[:m])) / np.sqrt(d[i])
+        d -= U[m]**2
+        d[i] = 0.0
+
+    return U.T
+
+
+def woodbury_preconditioner(U, noise):
+    """Function applying (U U^T + noise*I)^-1 to a vector or matrix."""
+    from scipy.linalg import cho_factor, cho_solve
+
+    factor = cho_factor(np.dot(U.T, U) + noise*np.eye(U.shape[1]), lower=True)
+
+    def apply(r):
+        return (r - np.dot(U, cho_solve(factor, np.dot(U.T, r)))) / noise
+
+    return apply
+
+
+def lanczos_logdet(matvec, N, n_probes=16, n_steps=30, random_state=None):
+    """Stochastic Lanczos quadrature estimate of log det A.
+
+       For each of n_probes Rademacher vectors z, n_steps Lanczos iterations
+       give a tridiagonal T whose eigen-decomposition provides a Gauss
+       quadrature of z^T log(A) z. Costs n_steps matvecs with n_probes columns."""
+    from scipy.linalg import eigh_tridiagonal
+
+    rng = np.random.default_rng(random_state)
+    Z = rng.choice([-1.0, 1.0], size=(N, n_probes))
+
+    q = Z / np.sqrt(N)
+    q_prev = np.zeros_like(q)
+    beta = np.zeros(n_probes)
+    alphas = np.zeros((n_steps, n_probes))
+    betas = np.zeros((n_steps, n_probes))
+    length = np.full(n_probes, n_steps)
+
+    for j in range(n_steps):
+        w = matvec(q) - beta*q_prev
+        alphas[j] = np.einsum('ij,ij->j', q, w)
+        w -= alphas[j]*q
+        beta = np.linalg.norm(w, axis=0)
+        betas[j] = beta
+
+        # - Lanczos breakdown: the Krylov space of this probe is exhausted
+        done = (beta < 1e-10) & (length == n_steps)
+        length[done] = j + 1
+
+        q_prev = q
+        q = w / np.where(beta == 0, 1.0, beta)
+
+    estimates = np.empty(n_probes)
+    for k in range(n_probes):
+        m = length[k]
+        theta, S = eigh_tridiagonal(alphas[:m,k], betas[:m-1,k])
+        estimates[k] = N*np.sum(S[0]**2 * np.log(np.maximum(theta, 1e-300)))
+
+    return estimates.mean()
+
+
+def log_marginal_likelihood(theta, X, y, kernel, eval_gradient=True, tol=1e-6, maxiter=1000,
+                            precond_rank=50, n_probes=16, lanczos_steps=30, random_state=0,
+                            max_bytes=gp_tiles.DEFAULT_MAX_BYTES):
+    """Stochastic log marginal likelihood (and gradient) at
+       theta = [kernel.theta..., log(noise)], see the module docstring.
+
+       Memory is O(N (n_probes + T) (2D + 1)) for D input dimensions and T
+       outputs; K is never stored. The kernel has to provide
+       gradient_quadform()."""
+
+    kernel = kernel.clone_with_theta(theta[:-1])
+    noise = np.exp(theta[-1])
+    N = len(X)
+
+    def matvec(v):
+        return gp_tiles.kernel_matvec(kernel, X, X, v, max_bytes) + noise*v
+
+    # - The same probes for the log-determinant and the trace estimate
+    seed = np.random.SeedSequence(random_state)
+    logdet = lanczos_logdet(matvec, N, n_probes, lanczos_steps, seed)
+
+    precond = None
+    if precond_rank > 0:
+        precond = woodbury_preconditioner(pivoted_cholesky(kernel, X, precond_rank), noise)
+
+    Y = y.reshape(N, -1)
+    T = Y.shape[1]
+    Z = np.random.default_rng(seed).choice([-1.0, 1.0], size=(N, n_probes)) if eval_gradient \
+        else np.zeros((N, 0))
+
+    solution, _, _ = conjugate_gradient(matvec, np.hstack([Y, Z]), precond, tol=tol, maxiter=maxiter)
+    alpha, KinvZ = solution[:,:T], solution[:,T:]
+
+    lml = -0.5*np.sum(Y*alpha) - 0.5*T*logdet - 0.5*T*N*np.log(2*np.pi)
+    if not eval_gradient:
+        return lml
+
+    # - sum_k U_k^T dK W_k = alpha^T dK alpha - T mean_z (K^-1 z)^T dK z
+    U = np.hstack([alpha, -T*KinvZ/n_probes])
+    W = np.hstack([alpha, Z])
+    grad = 0.5*np.append(kernel.gradient_quadform(X, U, W, max_bytes), noise*np.sum(U*W))
+
+    return lml, grad
+
+
+############################
+## -- Gaussian process -- ##
+############################
+
+class IterativeGaussianProcessRegressor(gp.GaussianProcessRegressor):
+    """GP regression solved by preconditioned CG without storing K.
+
+       Inputs, in addition to GaussianProcessRegressor:
+       - tol: relative residual tolerance of CG
+       - maxiter: maximum number of CG iterations
+       - precond_rank: rank of the pivoted Cholesky preconditioner (0 disables it)
+       - n_probes, lanczos_steps: size of the SLQ log-determinant estimate
+       - random_state: seed of the SLQ probe vectors
+
+       After fit() the model stores X_train, alpha and the N x k preconditioner
+       factor U; K itself is never stored.
+       """
+
+    fitted_arrays = ('X_train', 'y_train', 'alpha', 'U')
+
+    def __init__(self, kernel=gp.kernel, noise=0.00005, jitter=1e-6,
+                 max_bytes=gp_tiles.DEFAULT_MAX_BYTES, tol=1e-6, maxiter=1000,
+                 precond_rank=50, n_probes=16, lanczos_steps=30, random_state=None):
+        super().__init__(kernel=kernel, noise=noise, jitter=jitter, max_bytes=max_bytes)
+        self.tol = tol
+        self.maxiter = maxiter
+        self.precond_rank = precond_rank
+        self.n_probes = n_probes
+        self.lanczos_steps = lanczos_steps
+        self.random_state = random_state
+
+    def matvec(self, v):
+        """(K + noise*I) v computed in tiles."""
+        return gp_tiles.kernel_matvec(self.kernel, self.X_train, self.X_train, v, self.max_bytes) + self.noise*v
+
+    def solve(self, b):
+        """Solve (K + noise*I) x = b by preconditioned CG."""
+        x, self.n_iter, self.residual = conjugate_gradient(self.matvec, b, self.precond,
+                                                           tol=self.tol, maxiter=self.maxiter)
+        return x
+
+    def fit(self, X, y):
+        """Compute the weights alpha = (K + noise*I)^-1 y iteratively."""
+
+        self.X_train = np.atleast_2d(np.asarray(X, dtype=float))
+        self.y_train = np.asarray(y, dtype=float)
+
+        self.U = np.zeros((len(self.X_train), 0))
+        if self.precond_rank > 0:
+            self.U = pivoted_cholesky(self.kernel, self.X_train, self.precond_rank)
+        self.restore()
+
+        self.alpha = self.solve(self.y_train)
+
+        return self
+
+    def restore(self):
+        """Rebuild the preconditioner from U and reset the cached log-determinant."""
+
+        self.precond = None
+        if self.U.shape[1] > 0:
+            self.precond = woodbury_preconditioner(self.U, self.noise)
+        self._logdet = None
+
+        return self
+
+    def log_marginal_likelihood(self):
+        """Log marginal likelihood with the log-determinant estimated by SLQ."""
+
+        if self._logdet is None:
+            self._logdet = lanczos_logdet(self.matvec, len(self.X_train), self.n_probes,
+                                          self.lanczos_steps, self.random_state)
+
+        N = len(self.y_train)
+        return (-0.5*np.einsum('i...,i...->...', self.y_train, self.alpha)
+                - 0.5*self._logdet - 0.5*N*np.log(2*np.pi))
+
+    def likelihood_objective(self):
+        """log_marginal_likelihood() with the solver settings of the model,
+           used by gp_optimize.optimize() instead of the dense objective."""
+        import functools
+
+        seed = int(np.random.default_rng(self.random_state).integers(2**32))
+        return functools.partial(log_marginal_likelihood, tol=self.tol, maxiter=self.maxiter,
+                                 precond_rank=self.precond_rank, n_probes=self.n_probes,
+                                 lanczos_steps=self.lanczos_steps, random_state=seed,
+                                 max_bytes=self.max_bytes)
+
+    def _predict_cov(self, Xtest):
+        Ks = gp_tiles.kernel_matrix(self.kernel, self.X_train, Xtest, self.max_bytes)
+        mu = np.dot(Ks.T, self.alpha)
+        cov = gp_tiles.kernel_matrix(self.kernel, Xtest, Xtest, self.max_bytes)
+        cov -= np.dot(Ks.T, self.solve(Ks))
+
+        return mu, cov
+
+    def predict_tiles(self, Xtest, return_std=False, return_var=False):
+        """Stream predictions for consecutive blocks of test points, see
+           GaussianProcessRegressor.predict_tiles. The variances need one
+           block CG solve per tile."""
+
+        Xtest = np.atleast_2d(np.asarray(Xtest, dtype=float))
+
+        for rows, Ks in gp_tiles.iter_kernel_tiles(self.kernel, Xtest, self.X_train, self.max_bytes):
+            mu = np.dot(Ks, self.alpha)
+
+            if not (return_std or return_var):
+                yield rows, mu, None
+                continue
+
+            Kt = np.array(Ks.T)
+            s2 = gp_tiles.kernel_diag(self.kernel, Xtest[rows]) - np.einsum('ij,ij->j', Kt, self.solve(Kt))
+            np.maximum(s2, 0.0, out=s2)
+
+            yield rows, mu, (np.sqrt(s2) if return_std else s2)
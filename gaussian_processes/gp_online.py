@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Online GP regression. New observations extend the existing Cholesky factor
+L of K + noise*I in O(N^2) per point instead of refactorising from scratch,
+and the oldest observations can be dropped (sliding window) with rank-one
+updates of the remaining factor, so the cost per step stays flat over a
+long-running stream.
+"""
+
+import numpy as np
+
+import gp
+import gp_tiles
+
+
+def cholesky_update(L, x, downdate=False):
+    """Rank-one update (or downdate) of a lower Cholesky factor in place.
+
+       On return L L^T equals the old L L^T + x x^T (- x x^T for a downdate).
+       x is overwritten. Costs O(N^2); L should be Fortran ordered so that the
+       column operations are contiguous."""
+
+    sign = -1.0 if downdate else 1.0
+
+    for k in range(len(x)):
+        r2 = L[k,k]**2 + sign*x[k]**2
+        if r2 <= 0.0:
+            raise np.linalg.LinAlgError("Cholesky downdate is not positive definite")
+
+        r = np.sqrt(r2)
+        c = r / L[k,k]
+        s = x[k] / L[k,k]
+        L[k,k] = r
+
+        if k + 1 < len(x):
+            L[k+1:,k] += sign*s*x[k+1:]
+            L[k+1:,k] /= c
+            x[k+1:] *= c
+            x[k+1:] -= s*L[k+1:,k]
+
+    return L
+
+
+class OnlineGaussianProcessRegressor(gp.GaussianProcessRegressor):
+    """Exact GP regression that is updated one observation (or block) at a time.
+
+       Inputs, in addition to GaussianProcessRegressor:
+       - window: maximum number of training points kept. When exceeded the
+         oldest points are removed after each update. None keeps everything.
+       """
+
+    def __init__(self, kernel=gp.kernel, noise=0.00005, jitter=1e-6,
+                 max_bytes=gp_tiles.DEFAULT_MAX_BYTES, window=None):
+        super().__init__(kernel=kernel, noise=noise, jitter=jitter, max_bytes=max_bytes)
+        self.window = window
+
+    def fit(self, X, y):
+        super().fit(X, y)
+        return self._apply_window()
+
+    def update(self, X, y):
+        """Add new observations by extending the Cholesky factor.
+
+           With N points stored and k new ones this costs O(N^2 k + N k^2 + k^3).
+           The model is only modified once every new array has been computed."""
+        from scipy.linalg import cho_solve, solve_triangular
+
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+
+        if not hasattr(self, 'L'):
+            return self.fit(X, y)
+
+        N, k = len(self.X_train), len(X)
+        y = y.reshape((k,) + np.shape(self.y_train)[1:])
+
+        # - [[L, 0], [B^T, C]] with B = L \ K(X_train, X), C C^T = K(X, X) + noise*I - B^T B,
+        # - with the jitter of the existing factor on the new diagonal as well
+        B = solve_triangular(self.L, gp_tiles.kernel_matrix(self.kernel, self.X_train, X, self.max_bytes),
+                             lower=True, check_finite=False)
+        BtB = np.dot(B.T, B)
+        jitter_added = getattr(self, 'jitter_added', 0.0)
+
+        def build():
+            S = gp_tiles.kernel_matrix(self.kernel, X, X, self.max_bytes)
+            S[np.diag_indices_from(S)] += self.noise + jitter_added
+            S -= BtB
+            return S
+
+        # - Any extra jitter needed here only applies to the new points
+        C, _ = gp.jittered_cholesky(build, self.jitter)
+
+        L = np.zeros((N + k, N + k), order='F')
+        L[:N,:N] = self.L
+        L[N:,:N] = B.T
+        L[N:,N:] = C
+
+        X_train = np.concatenate([self.X_train, X])
+        y_train = np.concatenate([self.y_train, y])
+        alpha = cho_solve((L, True), y_train, check_finite=False)
+
+        self.L, self.X_train, self.y_train, self.alpha = L, X_train, y_train, alpha
+
+        return self._apply_window()
+
+    def remove_oldest(self, n=1):
+        """Remove the n oldest observations.
+
+           Writing L = [[L11, 0], [L21, L22]], the factor of the remaining
+           points satisfies L' L'^T = L22 L22^T + L21 L21^T, i.e. n rank-one
+           updates of L22 at O(N^2) each."""
+        from scipy.linalg import cho_solve
+
+        if n <= 0:
+            return self
+
+        if n >= len(self.X_train):
+            raise ValueError("Cannot remove all {} training points".format(len(self.X_train)))
+
+        L = np.array(self.L[n:,n:], order='F')
+        for j in range(n):
+            cholesky_update(L, np.array(self.L[n:,j]))
+
+        self.L = L
+        self.X_train = self.X_train[n:].copy()
+        self.y_train = self.y_train[n:].copy()
+        self.alpha = cho_solve((self.L, True), self.y_train, check_finite=False)
+
+        return self
+
+    def _apply_window(self):
+        if self.window is not None and len(self.X_train) > self.window:
+            self.remove_oldest(len(self.X_train) - self.window)
+        return self
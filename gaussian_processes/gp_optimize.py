@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Hyperparameter learning by maximising the log marginal likelihood.
+
+The parameter vector is theta = [kernel.theta..., log(noise)]. Each evaluation
+factorises K + noise*I once and uses the same Cholesky factor for the value
+
+    log p(y) = -0.5 y^T alpha - sum(log diag L) - N/2 log(2 pi)
+
+and its analytic gradient
+
+    d log p(y) / d theta_i = 0.5 tr((alpha alpha^T - K^-1) dK/dtheta_i).
+
+Random restarts are run in a process pool. Models that cannot afford the
+dense N x N factorisation provide their own objective with the same
+signature (see gp_iterative.log_marginal_likelihood), which optimize() picks
+up through model.likelihood_objective().
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import gp
+
+
+def log_marginal_likelihood(theta, X, y, kernel, eval_gradient=True):
+    """Log marginal likelihood (and its gradient) at theta = [kernel.theta..., log(noise)]."""
+    from scipy.linalg import cho_solve, cholesky
+
+    kernel = kernel.clone_with_theta(theta[:-1])
+    noise = np.exp(theta[-1])
+
+    K = kernel(X, X)
+    Ky = K + noise*np.eye(len(X))
+
+    try:
+        L = cholesky(Ky, lower=True, check_finite=False)
+    except np.linalg.LinAlgError:
+        return (-np.inf, np.zeros_like(theta)) if eval_gradient else -np.inf
+
+    # - For an N x T target matrix the likelihood is summed over the T outputs
+    alpha = cho_solve((L, True), y, check_finite=False)
+    T = 1 if y.ndim == 1 else y.shape[1]
+    lml = (-0.5*np.sum(y*alpha) - T*np.sum(np.log(np.diag(L)))
+           - 0.5*T*len(X)*np.log(2*np.pi))
+
+    if not eval_gradient:
+        return lml
+
+    # - W = alpha alpha^T - T K^-1, reusing the factor L
+    alpha = alpha.reshape(len(X), -1)
+    W = np.dot(alpha, alpha.T)
+    W -= T*cho_solve((L, True), np.eye(len(X)), check_finite=False)
+
+    grad = 0.5*np.append(kernel.gradient_trace(X, W, K), noise*np.trace(W))
+
+    return lml, grad
+
+
+def _maximise(theta0, X, y, kernel, bounds, likelihood=log_marginal_likelihood):
+    """Run L-BFGS-B from theta0, returns (theta, log marginal likelihood)."""
+    from scipy.optimize import minimize
+
+    def objective(theta):
+        lml, grad = likelihood(theta, X, y, kernel)
+        if not np.isfinite(lml):
+            return np.inf, np.zeros_like(theta)
+        return -lml, -grad
+
+    result = minimize(objective, theta0, jac=True, method='L-BFGS-B', bounds=bounds)
+
+    return result.x, -result.fun
+
+
+def fit_hyperparameters(X, y, kernel=gp.kernel, noise=0.00005, n_restarts=0,
+                        bounds=(-12.0, 5.0), n_jobs=None, random_state=None,
+                        likelihood=log_marginal_likelihood):
+    """Maximise the log marginal likelihood over the kernel hyperparameters and noise.
+
+       Inputs:
+       - kernel, noise: starting point of the first optimisation
+       - n_restarts: number of extra runs from log-uniform random starting points
+       - bounds: (low, high) bounds on every log hyperparameter
+       - n_jobs: size of the process pool used for the restarts (default: all CPUs)
+       - likelihood: function (theta, X, y, kernel) -> (value, gradient),
+         by default the exact log_marginal_likelihood
+
+       Returns (kernel, noise, log marginal likelihood) of the best run."""
+
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    y = np.asarray(y, dtype=float)
+    rng = np.random.default_rng(random_state)
+
+    theta0 = np.append(kernel.theta, np.log(noise))
+    bounds = [bounds]*len(theta0)
+
+    starts = [theta0] + [rng.uniform(*zip(*bounds)) for _ in range(n_restarts)]
+
+    if n_restarts == 0 or n_jobs == 1:
+        results = [_maximise(theta, X, y, kernel, bounds, likelihood) for theta in starts]
+    else:
+        n_jobs = n_jobs or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(starts))) as pool:
+            futures = [pool.submit(_maximise, theta, X, y, kernel, bounds, likelihood)
+                       for theta in starts]
+            results = [future.result() for future in futures]
+
+    theta, lml = max(results, key=lambda result: result[1])
+
+    return kernel.clone_with_theta(theta[:-1]), float(np.exp(theta[-1])), lml
+
+
+def optimize(model, X, y, **kwargs):
+    """Learn the hyperparameters of a regressor on (X, y) and refit it.
+
+       Keyword arguments are passed to fit_hyperparameters(). Models with a
+       likelihood_objective() method (the iterative regressor) are tuned with
+       that objective instead of the dense one."""
+
+    if hasattr(model, 'likelihood_objective'):
+        kwargs.setdefault('likelihood', model.likelihood_objective())
+    model.kernel, model.noise, _ = fit_hyperparameters(X, y, kernel=model.kernel,
+                                                       noise=model.noise, **kwargs)
+    return model.fit(X, y)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Plotting helpers for the GP regression module. Kept separate from gp.py so
+that matplotlib is only imported when a plot is requested.
+"""
+
+import matplotlib.pyplot as pl
+
+
+def plot_predictive(X, y, Xtest, mu, std, truth=None, filename=None, axis=(-5, 5, -3, 3)):
+    """Training points, mean predictions plus 3 standard deviations."""
+
+    fig = pl.figure()
+    pl.plot(X, y, 'r+', ms=20)
+    if truth is not None:
+        pl.plot(Xtest, truth(Xtest), 'b-')
+    pl.gca().fill_between(Xtest.flat, mu-3*std, mu+3*std, color="#dddddd")
+    pl.plot(Xtest, mu, 'r--', lw=2)
+    pl.title('Mean predictions plus 3 st.deviations')
+    pl.axis(axis)
+
+    if filename is not None:
+        pl.savefig(filename, bbox_inches='tight')
+
+    return fig
+
+
+def plot_samples(Xtest, samples, title='', filename=None, axis=(-5, 5, -3, 3)):
+    """Functions sampled from the GP evaluated at Xtest."""
+
+    fig = pl.figure()
+    pl.plot(Xtest, samples)
+    pl.title(title)
+    pl.axis(axis)
+
+    if filename is not None:
+        pl.savefig(filename, bbox_inches='tight')
+
+    return fig
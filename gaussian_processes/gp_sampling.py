@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Pathwise sampling of GP posterior functions.
+
+A prior function is approximated with F random Fourier features,
+
+    f(x) = phi(x) w,  phi(x) = sqrt(2 variance / F) cos(x omega^T + b),  w ~ N(0, I),
+
+and turned into a posterior function with Matheron's rule
+
+    f_post(x) = f(x) + k(x, X) (K + noise*I)^-1 (y - f(X) - eps),  eps ~ N(0, noise*I).
+
+Once the N x S correction weights are computed, each of the S sampled functions
+can be evaluated at arbitrary new points in O(F + N) per point, without any
+n x n covariance or Cholesky factorisation.
+"""
+
+import numpy as np
+
+import gp_tiles
+
+
+class PathwiseSampler:
+    """S posterior function draws of a fitted GP regressor.
+
+       Inputs:
+       - model: fitted regressor providing X_train, y_train, kernel, noise and
+         solve(b) = (K + noise*I)^-1 b (the exact, online and iterative regressors;
+         the sparse regressor solves with its approximation Q + Lambda)
+       - n_samples: number of functions S
+       - n_features: number of random Fourier features F
+       - random_state: seed or numpy Generator
+
+       The kernel has to provide sample_frequencies() and a variance (stationary
+       kernels with a known spectral density).
+       """
+
+    def __init__(self, model, n_samples=1000, n_features=1000, random_state=None):
+        rng = np.random.default_rng(random_state)
+
+        self.model = model
+        self.kernel = model.kernel
+        self.n_samples = n_samples
+
+        if np.ndim(model.y_train) != 1:
+            raise ValueError("Pathwise sampling supports a single output only")
+
+        X = model.X_train
+        N, D = X.shape
+
+        self.omega = self.kernel.sample_frequencies(n_features, D, rng)
+        self.phase = rng.uniform(0, 2*np.pi, size=n_features)
+        self.scale = np.sqrt(2*self.kernel.variance / n_features)
+        self.w = rng.standard_normal((n_features, n_samples))
+
+        # - Matheron's rule update weights (N x S)
+        residual = model.y_train.reshape(-1,1) - self.prior(X)
+        residual -= np.sqrt(model.noise)*rng.standard_normal((N, n_samples))
+        self.v = model.solve(residual)
+
+    def features(self, Xtest):
+        """Random Fourier features phi(Xtest), n x F."""
+        Phi = np.dot(Xtest, self.omega.T)
+        Phi += self.phase
+        np.cos(Phi, out=Phi)
+        Phi *= self.scale
+        return Phi
+
+    def prior(self, Xtest):
+        """Prior function draws at Xtest, n x S."""
+        return np.dot(self.features(np.atleast_2d(Xtest)), self.w)
+
+    def __call__(self, Xtest):
+        """Posterior function draws at Xtest, n x S, evaluated in tiles."""
+
+        Xtest = np.atleast_2d(np.asarray(Xtest, dtype=float))
+        out = np.empty((len(Xtest), self.n_samples))
+
+        for rows, Ks in gp_tiles.iter_kernel_tiles(self.kernel, Xtest, self.model.X_train,
+                                                   self.model.max_bytes):
+            out[rows] = self.prior(Xtest[rows])
+            out[rows] += np.dot(Ks, self.v)
+
+        return out
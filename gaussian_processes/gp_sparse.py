@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Sparse GP regression with M inducing points Z.
+
+All three approximations replace K by Q = K_fu K_uu^-1 K_uf plus a diagonal
+Lambda and differ only in Lambda, the marginal likelihood and the predictive
+variance:
+- 'sor': subset of regressors, Lambda = noise, degenerate predictive variance
+- 'fitc': fully independent training conditional, Lambda = diag(K - Q) + noise
+- 'vfe': variational free energy (Titsias 2009), Lambda = noise and a
+  -tr(K - Q)/(2 noise) correction of the (lower bound on the) marginal likelihood
+
+Training costs O(N M^2), the predictive mean O(M) and the predictive variance
+O(M^2) per test point.
+"""
+
+import numpy as np
+
+import gp
+import gp_tiles
+
+
+METHODS = ('sor', 'fitc', 'vfe')
+
+
+def kmeans_pp(X, M, random_state=None):
+    """Choose M rows of X by k-means++ seeding in O(N M)."""
+
+    rng = np.random.default_rng(random_state)
+    N = len(X)
+    M = min(M, N)
+
+    index = np.empty(M, dtype=int)
+    index[0] = rng.integers(N)
+    d2 = np.sum((X - X[index[0]])**2, axis=1)
+
+    for m in range(1, M):
+        total = d2.sum()
+        if total > 0:
+            index[m] = min(np.searchsorted(np.cumsum(d2), rng.uniform(0, total)), N - 1)
+        else:
+            index[m] = rng.integers(N)
+        np.minimum(d2, np.sum((X - X[index[m]])**2, axis=1), out=d2)
+
+    return X[index].copy()
+
+
+class SparseGaussianProcessRegressor(gp.GaussianProcessRegressor):
+    """Inducing point GP regression.
+
+       Inputs, in addition to GaussianProcessRegressor:
+       - n_inducing: number of inducing points M chosen by k-means++
+       - inducing: user supplied M x D inducing inputs (overrides n_inducing)
+       - method: one of 'sor', 'fitc', 'vfe'
+       - random_state: seed of the k-means++ selection
+
+       After fit() the model stores the inducing inputs Z, the lower Cholesky
+       factor Luu of K_uu, the M-vector w such that mu(x) = k(x, Z) w and the
+       diagonal Lambda of the approximate training covariance Q + Lambda.
+       """
+
+    fitted_arrays = ('X_train', 'y_train', 'Z', 'Luu', 'Luu_inv', 'R', 'w', 'Lambda',
+                     'log_marginal_likelihood_value')
+
+    def __init__(self, kernel=gp.kernel, noise=0.00005, jitter=1e-6,
+                 max_bytes=gp_tiles.DEFAULT_MAX_BYTES, n_inducing=100,
+                 inducing=None, method='vfe', random_state=None):
+        super().__init__(kernel=kernel, noise=noise, jitter=jitter, max_bytes=max_bytes)
+
+        if method not in METHODS:
+            raise ValueError("Unknown sparse approximation '{}', use one of {}".format(method, METHODS))
+
+        self.n_inducing = n_inducing
+        self.inducing = inducing
+        self.method = method
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """Compute the inducing point posterior in O(N M^2)."""
+        from scipy.linalg import cholesky, solve_triangular
+
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        y = np.asarray(y, dtype=float)
+        N = len(X)
+
+        if self.inducing is not None:
+            Z = np.atleast_2d(np.asarray(self.inducing, dtype=float))
+        else:
+            Z = kmeans_pp(X, self.n_inducing, self.random_state)
+        M = len(Z)
+
+        Kuu = gp_tiles.kernel_matrix(self.kernel, Z, Z, self.max_bytes)
+        Kuu[np.diag_indices_from(Kuu)] += self.jitter
+        Luu = cholesky(Kuu, lower=True, check_finite=False)
+
+        # - V = Luu^-1 K_uf, so that Q = V^T V
+        Kuf = gp_tiles.kernel_matrix(self.kernel, Z, X, self.max_bytes)
+        V = solve_triangular(Luu, Kuf, lower=True, overwrite_b=True, check_finite=False)
+        del Kuf
+
+        # - diag(K - Q)
+        kq = gp_tiles.kernel_diag(self.kernel, X) - np.einsum('ij,ij->j', V, V)
+        np.maximum(kq, 0.0, out=kq)
+
+        if self.method == 'fitc':
+            lam = kq + self.noise
+        else:
+            lam = np.full(N, float(self.noise))
+
+        # - A = I + V Lambda^-1 V^T
+        Vl = V / np.sqrt(lam)
+        A = np.dot(Vl, Vl.T)
+        A[np.diag_indices_from(A)] += 1.0
+        LA = cholesky(A, lower=True, check_finite=False)
+
+        # - (Q + Lambda)^-1 = Lambda^-1 - Lambda^-1 V^T A^-1 V Lambda^-1
+        # - y can hold T outputs as columns, which share all of the above
+        yl = y / np.sqrt(lam).reshape((-1,) + (1,)*(y.ndim - 1))
+        c = solve_triangular(LA, np.dot(Vl, yl), lower=True, check_finite=False)
+
+        lml = (-0.5*(np.einsum('i...,i...->...', yl, yl) - np.einsum('i...,i...->...', c, c))
+               - 0.5*np.sum(np.log(lam)) - np.sum(np.log(np.diag(LA)))
+               - 0.5*N*np.log(2*np.pi))
+        if self.method == 'vfe':
+            lml -= 0.5*np.sum(kq) / self.noise
+
+        # - Prediction weights: mu(x) = k(x, Z) w, and with
+        # - R = LA^-1 Luu^-1: Sigma = R^T R is the posterior covariance of K_uu^-1 u
+        Luu_inv = solve_triangular(Luu, np.eye(M), lower=True, check_finite=False)
+        R = solve_triangular(LA, Luu_inv, lower=True, check_finite=False)
+
+        self.X_train = X
+        self.y_train = y
+        self.Z = Z
+        self.Luu = Luu
+        self.Luu_inv = Luu_inv
+        self.R = R
+        self.w = np.dot(R.T, c)
+        self.Lambda = lam
+        self.log_marginal_likelihood_value = lml
+
+        return self
+
+    def solve(self, b):
+        """Solve (Q + Lambda) x = b, the approximate training covariance, in
+           O(N M) per column with the Woodbury identity
+
+               (Q + Lambda)^-1 = Lambda^-1 - Lambda^-1 K_fu R^T R K_uf Lambda^-1.
+
+           K_fu is evaluated in tiles twice instead of being stored."""
+
+        b = np.asarray(b, dtype=float)
+        shape = (-1,) + (1,)*(b.ndim - 1)
+        out = b / self.Lambda.reshape(shape)
+
+        t = np.zeros((len(self.Z),) + b.shape[1:])
+        for rows, Kfu in gp_tiles.iter_kernel_tiles(self.kernel, self.X_train, self.Z, self.max_bytes):
+            t += np.dot(Kfu.T, out[rows])
+        t = np.dot(self.R.T, np.dot(self.R, t))
+
+        for rows, Kfu in gp_tiles.iter_kernel_tiles(self.kernel, self.X_train, self.Z, self.max_bytes):
+            out[rows] -= np.dot(Kfu, t) / self.Lambda[rows].reshape(shape)
+
+        return out
+
+    def inverse_diag(self):
+        """diag((Q + Lambda)^-1) from the Woodbury form of solve(), O(N M^2)."""
+
+        d = np.empty(len(self.X_train))
+        for rows, Kfu in gp_tiles.iter_kernel_tiles(self.kernel, self.X_train, self.Z, self.max_bytes):
+            d[rows] = np.sum(np.dot(Kfu, self.R.T)**2, axis=1)
+
+        return 1.0/self.Lambda - d/self.Lambda**2
+
+    def loo_predictive(self):
+        """Closed-form leave-one-out predictions under the approximate training
+           covariance Q + Lambda, see GaussianProcessRegressor.loo_predictive."""
+        return gp._loo(self.y_train, self.solve(self.y_train), self.inverse_diag())
+
+    def log_marginal_likelihood(self):
+        """Log marginal likelihood of the approximation (for 'vfe' a lower bound
+        on the exact one)."""
+        return self.log_marginal_likelihood_value
+
+    def _variance(self, Xtest, Ksu):
+        """Marginal predictive variance from the test x inducing kernel block."""
+
+        s2 = np.sum(np.dot(Ksu, self.R.T)**2, axis=1)
+
+        if self.method != 'sor':
+            q = np.sum(np.dot(Ksu, self.Luu_inv.T)**2, axis=1)
+            s2 += gp_tiles.kernel_diag(self.kernel, Xtest) - q
+
+        return np.maximum(s2, 0.0)
+
+    def _predict_cov(self, Xtest):
+        Ksu = gp_tiles.kernel_matrix(self.kernel, Xtest, self.Z, self.max_bytes)
+        mu = np.dot(Ksu, self.w)
+
+        P = np.dot(Ksu, self.R.T)
+        cov = np.dot(P, P.T)
+
+        if self.method != 'sor':
+            Q = np.dot(Ksu, self.Luu_inv.T)
+            cov += gp_tiles.kernel_matrix(self.kernel, Xtest, Xtest, self.max_bytes)
+            cov -= np.dot(Q, Q.T)
+
+        return mu, cov
+
+    def predict_tiles(self, Xtest, return_std=False, return_var=False):
+        """Stream predictions for consecutive blocks of test points, see
+           GaussianProcessRegressor.predict_tiles."""
+
+        Xtest = np.atleast_2d(np.asarray(Xtest, dtype=float))
+
+        for rows, Ksu in gp_tiles.iter_kernel_tiles(self.kernel, Xtest, self.Z, self.max_bytes):
+            mu = np.dot(Ksu, self.w)
+
+            if not (return_std or return_var):
+                yield rows, mu, None
+                continue
+
+            s2 = self._variance(Xtest[rows], Ksu)
+            yield rows, mu, (np.sqrt(s2) if return_std else s2)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Blocked kernel evaluation under a memory budget.
+
+The kernel matrix K(a, b) is computed in row (and, for matrix-vector products,
+column) tiles so that no len(a) x len(b) temporaries are created. Kernels which
+accept an `out` argument (like gp.kernel) write each tile in place into a
+preallocated buffer; other callables fall back to an ordinary call per tile.
+"""
+
+import numpy as np
+
+
+# - Default memory budget for a single kernel tile (bytes)
+DEFAULT_MAX_BYTES = 64 * 2**20
+
+
+def tile_rows(n_cols, max_bytes=DEFAULT_MAX_BYTES, itemsize=8):
+    """Number of rows of an n_cols wide tile that fit into max_bytes."""
+    return max(1, int(max_bytes // (itemsize * max(n_cols, 1))))
+
+
+def iter_slices(n, size):
+    """Consecutive slices of length size covering range(n)."""
+    for start in range(0, n, size):
+        yield slice(start, min(start + size, n))
+
+
+def evaluate(kernel, a, b, out=None):
+    """Evaluate kernel(a, b), in place into out when the kernel supports it."""
+
+    if out is None:
+        return kernel(a, b)
+
+    try:
+        return kernel(a, b, out=out)
+    except TypeError:
+        out[...] = kernel(a, b)
+        return out
+
+
+def kernel_matrix(kernel, a, b, max_bytes=DEFAULT_MAX_BYTES, out=None, dtype=np.float64):
+    """Full kernel matrix K(a, b), filled tile by tile.
+
+       Each block of rows is written in place into `out`, so the only memory
+       used is the output itself. The inputs are cast to dtype, so float32
+       tiles halve the memory and use single precision BLAS."""
+
+    if out is None:
+        out = np.empty((len(a), len(b)), dtype=dtype)
+
+    b = np.asarray(b, dtype=out.dtype)
+    for rows in iter_slices(len(a), tile_rows(len(b), max_bytes, out.itemsize)):
+        evaluate(kernel, np.asarray(a[rows], dtype=out.dtype), b, out=out[rows])
+
+    return out
+
+
+def iter_kernel_tiles(kernel, a, b, max_bytes=DEFAULT_MAX_BYTES, dtype=np.float64):
+    """Yield (rows, K(a[rows], b)) for consecutive row blocks of a.
+
+       The tiles share one buffer of at most max_bytes, so each tile is only
+       valid until the next one is requested."""
+
+    itemsize = np.dtype(dtype).itemsize
+    nrows = max(1, min(len(a), tile_rows(len(b), max_bytes, itemsize)))
+    buf = np.empty(nrows * len(b), dtype=dtype)
+    b = np.asarray(b, dtype=dtype)
+
+    for rows in iter_slices(len(a), nrows):
+        tile = buf[:(rows.stop - rows.start) * len(b)].reshape(-1, len(b))
+        yield rows, evaluate(kernel, np.asarray(a[rows], dtype=dtype), b, out=tile)
+
+
+def kernel_matvec(kernel, a, b, v, max_bytes=DEFAULT_MAX_BYTES, dtype=np.float64):
+    """Matrix-vector product K(a, b) v without storing K.
+
+       v can be a vector or a len(b) x T matrix. K is evaluated in row and
+       column tiles of at most max_bytes; the products are accumulated in the
+       precision of v."""
+
+    v = np.asarray(v)
+    out = np.zeros((len(a),) + v.shape[1:], dtype=np.result_type(v, dtype))
+
+    # - Roughly square tiles so that both a and b can be large
+    itemsize = np.dtype(dtype).itemsize
+    ncols = max(1, min(len(b), int(np.sqrt(max_bytes // itemsize))))
+    nrows = max(1, min(len(a), tile_rows(ncols, max_bytes, itemsize)))
+    buf = np.empty(nrows * ncols, dtype=dtype)
+
+    for cols in iter_slices(len(b), ncols):
+        width = cols.stop - cols.start
+        b_cols = np.asarray(b[cols], dtype=dtype)
+        for rows in iter_slices(len(a), nrows):
+            tile = buf[:(rows.stop - rows.start) * width].reshape(-1, width)
+            evaluate(kernel, np.asarray(a[rows], dtype=dtype), b_cols, out=tile)
+            out[rows] += np.dot(tile, v[cols])
+
+    return out
+
+
+def kernel_diag(kernel, a, block=256):
+    """Diagonal of K(a, a).
+
+       Uses kernel.diag(a) when the kernel provides it, otherwise evaluates
+       small diagonal blocks so the cost stays O(len(a) * block)."""
+
+    if hasattr(kernel, 'diag'):
+        return kernel.diag(a)
+
+    diag = np.empty(len(a))
+    for rows in iter_slices(len(a), block):
+        diag[rows] = np.diag(kernel(a[rows], a[rows]))
+
+    return diag
@@ -115,8 +115,17 @@ class Environment:
         self.walls = walls
         self.winds = winds
 
-        # Similarly the statespace of the environment is the set of agent states
-        self.statespace = [(x,y) for x in range(self.gridwidth) for y in range(self.gridheight) if self.is_position_allowed((x,y))]
+        # - Occupancy grid (True where the agent is allowed) and position -> state
+        # - index lookup (-1 on walls). States are numbered in statespace order.
+        self.occupancy = np.ones(self.gridsize, dtype=bool)
+        wall_array = np.array(walls, dtype=np.int64).reshape(-1, 2)
+        inside = np.all((wall_array >= 0) & (wall_array < self.gridsize), axis=1)
+        self.occupancy[wall_array[inside,0], wall_array[inside,1]] = False
+
+        self.positions = np.argwhere(self.occupancy)
+        self.state_index = np.full(self.gridsize, -1, dtype=np.int32)
+        self.state_index[self.occupancy] = np.arange(len(self.positions), dtype=np.int32)
+        self._statespace = None
 
         # - Target position
         self.target_position = target_position
@@ -128,7 +137,8 @@ class Environment:
         # - Default reward assignment:
         # - Every possible action, state pair results in -1 reward
         # - signifying one step of the agent.
-        if Preward == "default":
+        self.default_reward = Preward == "default"
+        if self.default_reward:
             self.Preward = lambda agent_action, agent_state: -1
         # - You can also pass your custom reward distribution function
         # - It should accept two inputs:
@@ -142,17 +152,42 @@ class Environment:
         ## -- Transition probability distribution function -- ##
         ########################################################
 
-        if Ptransition == "default":
-            self.Ptransition = self.generate_default_Ptransition()
+        # - The default dynamics are kept as neighbour tables, the dict form is
+        # - only built if Ptransition is accessed
+        self._mdp = None
+        self.default_dynamics = isinstance(Ptransition, str) and Ptransition == "default"
+        if self.default_dynamics:
+            self._Ptransition = None
+            self.neighbours, self.wind_neighbours = self.neighbour_tables()
         else:
-            self.Ptransition = Ptransition
-
+            self._Ptransition = Ptransition
 #       self.rewards = -np.ones(shape=(self.width, self.height, self.nactions))
 #       self.states = np.array([(x,y) for x in range(self.width) for y in range(self.height)])
 #       self.actions = np.array( [[[range(4)] for y in range(self.height)]] for x in range(self.width) )
 
         self.agent_position = agent_position
 
+    @property
+    def statespace(self):
+        """List of the allowed positions, built on first access."""
+        if self._statespace is None:
+            self._statespace = [tuple(position) for position in self.positions.tolist()]
+        return self._statespace
+
+    @property
+    def Ptransition(self):
+        """Transition probabilities in dict form. For the default dynamics the
+           dict is built from the compiled model on first access."""
+        if self._Ptransition is None:
+            self._Ptransition = self.compile().to_Ptransition()
+        return self._Ptransition
+
+    @Ptransition.setter
+    def Ptransition(self, Ptransition):
+        self._Ptransition = Ptransition
+        self.default_dynamics = False
+        self._mdp = None
+
     def is_position_allowed(self, position):
         """Check if a proposed position is allowed."""
         x, y = position
@@ -166,10 +201,49 @@ class Environment:
         if y >= self.gridheight:
             return False
 
-        if position in self.walls:
-            return False
+        return bool(self.occupancy[x, y])
+
+    def lookup(self, x, y):
+        """State indices of the position arrays x, y, -1 outside the grid or on walls."""
+        inside = (x >= 0) & (x < self.gridwidth) & (y >= 0) & (y < self.gridheight)
+        index = np.full(np.shape(x), -1, dtype=np.int32)
+        index[inside] = self.state_index[x[inside], y[inside]]
+        return index
+
+    def neighbour_tables(self):
+        """Vectorised default dynamics.
+
+           Returns
+           - neighbours: A x S array, the state reached by each action without
+             wind (-1 if the move is blocked)
+           - wind_neighbours: (states, strengths, A x W array of the states the
+             wind shifts the agent to, -1 if blocked) for the W windy states"""
+
+        # - Index map with a border of -1, so that every one step move is a
+        # - constant offset into the flattened array
+        padded = np.full((self.gridwidth + 2, self.gridheight + 2), -1, dtype=np.int32)
+        padded[1:-1,1:-1] = self.state_index
+        padded = padded.ravel()
+        stride = self.gridheight + 2
+        base = (self.positions[:,0] + 1)*stride + self.positions[:,1] + 1
+
+        neighbours = np.empty((len(possible_actions), len(self.positions)), dtype=np.int32)
+        for a, (dx, dy) in enumerate(possible_actions):
+            np.take(padded, base + (dx*stride + dy), out=neighbours[a])
+
+        x, y = self.positions.T
+
+        windy = [(position, wind) for position, wind in self.winds.items()
+                 if self.is_position_allowed(position)]
+        states = np.array([self.state_index[position] for position, wind in windy], dtype=np.int32)
+        strengths = np.array([wind.strength for position, wind in windy], dtype=float)
+        shift = np.array([wind.direction for position, wind in windy], dtype=np.int64).reshape(-1, 2)
+
+        shifted = np.empty((len(possible_actions), len(states)), dtype=np.int32)
+        for a, (dx, dy) in enumerate(possible_actions):
+            shifted[a] = self.lookup(x[states] + dx + shift[:,0], y[states] + dy + shift[:,1])
 
-        return True
+        return neighbours, (states, strengths, shifted)
 
     def update(self, action):
         """Receive agent's action signal, update internal representation,
@@ -177,12 +251,14 @@ class Environment:
 
         reward = self.Preward(action, self.agent_position)
 
-        state = self.agent_position
-
-        choices = list(self.Ptransition[(state, action)].keys())
-        probabilities = list(self.Ptransition[(state, action)].values())
-        new_position = choices[np.random.choice(a=len(choices), size=1,
-                p=probabilities)[0]]
+        # - O(1) sampling from the precomputed alias tables with a single draw
+        mdp = self.compile()
+        row = mdp.action_index(action)*mdp.nstates + mdp.index(self.agent_position)
+        try:
+            new_position = mdp.state(mdp.sampler.sample_one(row, np.random.random()))
+        except ValueError:
+            raise ValueError("Ptransition has no entry for state {} and action {}".format(
+                self.agent_position, action)) from None
 
         self.agent_position = new_position
 
@@ -244,7 +320,7 @@ class Environment:
             transition_probabilities[pos] = prob
 
 
-        not_allowed_states = [state for state in transition_probabilities.keys() if state not in self.statespace]
+        not_allowed_states = [state for state in transition_probabilities.keys() if not self.is_position_allowed(state)]
         for pos in not_allowed_states:
             transition_probabilities.pop(pos)
 
@@ -257,6 +333,16 @@ class Environment:
 
         return transition_probabilities
 
+    def compile(self):
+        """Compiled array representation of the dynamics, see gridworld_mdp.TabularMDP.
+
+           The result is cached, so Ptransition and Preward should not be
+           modified afterwards."""
+        if self._mdp is None:
+            import gridworld_mdp
+            self._mdp = gridworld_mdp.TabularMDP.from_environment(self)
+        return self._mdp
+
     
     def plot(self, figsize=(2,2)):
     
@@ -309,16 +395,30 @@ class Environment:
 
 
 class Agent:
+    """Agent acting in an environment.
+
+       The transitions of action() are stored in experience, a fixed-size
+       gridworld_experience.ExperienceBuffer of state and action indices
+       (by default the last experience_capacity transitions)."""
     
-    def __init__(self, environment, initial_pos, policy, gamma=1.0):
+    def __init__(self, environment, initial_pos, policy, gamma=1.0, experience=None,
+                 experience_capacity=2**20):
+        import gridworld_experience
+
         self.environment = environment
         self.current_state = initial_pos
         self.time_step = 0
         self.gamma = gamma
         self.recent_reward = 0.0
         self.gain = 0.0
+        self.discount = 1.0
         self.policy = policy
-        self.experience = []
+
+        self.mdp = environment.compile()
+        if experience is None:
+            experience = gridworld_experience.ExperienceBuffer(
+                experience_capacity, gridworld_experience.index_dtype(self.mdp.nstates))
+        self.experience = experience
     
     def get_current_state(self):
         return self.current_state  
@@ -327,8 +427,9 @@ class Agent:
     def action(self, action, doPlot=False, figsize=(2,2)):
         new_state, reward = self.environment.update(action)
 
-        new_experince = (action, reward, new_state)
-        self.experience.append(new_experince)
+        self.experience.append(self.mdp.index(self.current_state), self.mdp.action_index(action),
+                               reward, self.mdp.index(new_state),
+                               tuple(new_state) == tuple(self.environment.target_position))
         self.current_state = new_state
 
     def actions(self, actions, doPlot=False, figsize=(2,2)):
@@ -337,7 +438,8 @@ class Agent:
             new_state, reward = self.environment.update(action)
             self.current_state = new_state
             self.recent_reward = reward
-            self.gain += ((self.gamma)**(self.time_step))*reward
+            self.gain += self.discount*reward
+            self.discount *= self.gamma
             self.time_step += 1 
 
             if doPlot:
@@ -350,12 +452,16 @@ class Agent:
         self.recent_reward = 0.0
         self.time_step = 0
         self.gain = 0.0
+        self.discount = 1.0
 
-    def follow_policy(self, nsteps):
+    def follow_policy(self, nsteps, verbose=True):
+        """Take nsteps actions of the policy. For many rollouts see
+           gridworld_montecarlo.monte_carlo_evaluation."""
         
         for step in range(nsteps):
             action = self.policy(self.current_state)
-            print("Action: {}".format(action))
+            if verbose:
+                print("Action: {}".format(action))
             self.action(action)
 
 
@@ -456,20 +562,22 @@ def random_policy(state):
     return action
 
 
-def policy_evaluation(environment, policy, initial_value_function):
-    
-    value_function = initial_value_function
-    value_function_shape = value_function.shape
-    
-    for state in environment.states:
+def policy_evaluation(environment, policy, initial_value_function=None, gamma=1.0,
+                      tol=1e-6, max_iter=10000):
+    """Iterative policy evaluation of a policy in the environment.
 
-        state_x = state[0]
-        state_y = state[1]
-        
-#       for 
-        
-#       value_function 
+       The policy can be any form accepted by gridworld_planning.policy_matrix,
+       e.g. a dict {state: action}, a deterministic function state -> action
+       or random_policy, evaluated as the uniform policy. The value functions
+       are width x height arrays, NaN on the walls."""
+    import gridworld_planning
 
+    mdp = environment.compile()
 
+    V0 = None
+    if initial_value_function is not None:
+        V0 = np.asarray(initial_value_function, dtype=float)[mdp.positions[:,0], mdp.positions[:,1]]
 
+    V, info = gridworld_planning.policy_evaluation(mdp, policy, gamma, tol, max_iter, V0)
 
+    return mdp.to_grid(V)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Fixed-size experience store for gridworld agents.
+
+Transitions are records of a structured NumPy array preallocated at
+construction,
+
+    state       state index (see gridworld_mdp.TabularMDP), int16 when the
+                number of states allows it
+    action      action index, int16
+    reward      float32
+    next_state  state index, same type as state
+    done        bool, True if next_state is terminal
+
+which is 11 bytes per transition with int16 states instead of the 200 or so
+of a Python tuple. The array is a ring buffer: once capacity transitions are
+stored, every new one overwrites the oldest.
+
+Uniform minibatches are drawn in O(1) per transition. With prioritised=True
+the buffer also keeps a sum tree of the priorities p_i^alpha, and
+minibatches are drawn proportionally to them with one vectorised descent of
+the tree (log2(capacity) array operations per batch, whatever its size).
+
+With spill_dir set, the buffer is divided into segments of segment_size
+records, and a segment that is about to be overwritten is first written to
+spill_dir as a .npy file, so long runs keep their full history on disk
+while the memory used stays fixed. Spilled segments are opened as read-only
+memory maps by spilled_segment().
+"""
+
+import os
+
+import numpy as np
+
+
+def index_dtype(n):
+    """Smallest signed integer type holding the indices 0 .. n - 1 (at least int16)."""
+    for dtype in (np.int16, np.int32):
+        if n <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def experience_dtype(state_dtype=np.int16):
+    """Structured dtype of one transition record."""
+    return np.dtype([('state', state_dtype), ('action', np.int16), ('reward', np.float32),
+                     ('next_state', state_dtype), ('done', np.bool_)])
+
+
+class ExperienceBuffer:
+    """Ring buffer of transition records, see the module docstring.
+
+       Inputs:
+       - capacity: number of records kept in memory
+       - state_dtype: integer type of the state indices
+       - prioritised: keep priorities for sample_prioritised()
+       - alpha: priority exponent, the sampling probabilities are
+         proportional to priority**alpha
+       - spill_dir: directory receiving overwritten segments (None: discard)
+       - segment_size: records per spilled segment (default capacity // 8)
+       """
+
+    def __init__(self, capacity=2**20, state_dtype=np.int16, prioritised=False, alpha=0.6,
+                 spill_dir=None, segment_size=None):
+
+        self.capacity = int(capacity)
+        self.state_dtype = np.dtype(state_dtype)
+        self.prioritised = prioritised
+        self.alpha = alpha
+        self.spill_dir = spill_dir
+        self.segment_size = max(1, self.capacity // 8) if segment_size is None else int(segment_size)
+
+        # - np.zeros leaves untouched pages unallocated until they are written
+        self.data = np.zeros(self.capacity, dtype=experience_dtype(self.state_dtype))
+        self.position = 0
+        self.size = 0
+        self.total = 0
+
+        self.spilled = []
+        if spill_dir is not None:
+            if self.capacity % self.segment_size:
+                raise ValueError("segment_size must divide capacity")
+            os.makedirs(spill_dir, exist_ok=True)
+
+        if prioritised:
+            # - Sum tree over a power of two number of leaves, leaf i at tree[leaves + i]
+            self.leaves = 1 << max(0, self.capacity - 1).bit_length()
+            self.tree = np.zeros(2*self.leaves)
+            self.max_priority = 1.0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        """Records in chronological order, index 0 is the oldest one kept."""
+        return self.data[self.slots(np.arange(self.size)[index])]
+
+    def slots(self, index):
+        """Ring slots of chronological indices."""
+        return (self.position - self.size + np.asarray(index)) % self.capacity
+
+    def append(self, state, action, reward, next_state, done=False):
+        """Store one transition."""
+
+        slot = self.position
+        if self.spill_dir is not None and self.size == self.capacity and slot % self.segment_size == 0:
+            self._spill(slot)
+
+        self.data[slot] = (state, action, reward, next_state, done)
+        if self.prioritised:
+            self._set_priorities(np.array([slot]), self.max_priority**self.alpha)
+
+        self.position = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.total += 1
+
+    def extend(self, states, actions, rewards, next_states, dones=False):
+        """Store a batch of transitions, e.g. one step of a VectorEnvironment."""
+
+        states, actions, rewards, next_states, dones = np.broadcast_arrays(
+            states, actions, rewards, next_states, dones)
+        n = len(states)
+
+        # - Write in chunks that stop at segment (and ring) boundaries
+        start = 0
+        while start < n:
+            slot = self.position
+            end = start + min(n - start, self.segment_size - slot % self.segment_size,
+                              self.capacity - slot)
+            if self.spill_dir is not None and self.size == self.capacity and slot % self.segment_size == 0:
+                self._spill(slot)
+
+            records = self.data[slot:slot + end - start]
+            records['state'] = states[start:end]
+            records['action'] = actions[start:end]
+            records['reward'] = rewards[start:end]
+            records['next_state'] = next_states[start:end]
+            records['done'] = dones[start:end]
+            if self.prioritised:
+                self._set_priorities(np.arange(slot, slot + end - start), self.max_priority**self.alpha)
+
+            self.position = (slot + end - start) % self.capacity
+            self.size = min(self.size + end - start, self.capacity)
+            self.total += end - start
+            start = end
+
+    def sample(self, batch_size, rng=None):
+        """Uniform minibatch. Returns (slots, records)."""
+
+        if self.size == 0:
+            raise ValueError("Cannot sample from an empty buffer")
+
+        rng = np.random.default_rng(rng)
+        slots = self.slots(rng.integers(0, self.size, size=batch_size))
+
+        return slots, self.data[slots]
+
+    def sample_prioritised(self, batch_size, beta=0.4, rng=None):
+        """Minibatch drawn proportionally to priority**alpha.
+
+           Returns (slots, records, weights), weights being the importance
+           sampling corrections (size P(i))**-beta normalised by their maximum."""
+
+        if not self.prioritised:
+            raise ValueError("The buffer was created with prioritised=False")
+        if self.size == 0:
+            raise ValueError("Cannot sample from an empty buffer")
+
+        rng = np.random.default_rng(rng)
+        tree = self.tree
+        u = rng.random(batch_size) * tree[1]
+
+        node = np.ones(batch_size, dtype=np.int64)
+        while node[0] < self.leaves:
+            left = tree[2*node]
+            right = u >= left
+            u -= np.where(right, left, 0.0)
+            node = 2*node + right
+
+        # - Rounding can reach an empty leaf past the stored records
+        slots = np.minimum(node - self.leaves, self.capacity - 1)
+        if self.size < self.capacity:
+            slots = np.minimum(slots, self.size - 1)
+
+        probabilities = tree[self.leaves + slots] / tree[1]
+        weights = (self.size * probabilities)**-beta
+        weights /= weights.max()
+
+        return slots, self.data[slots], weights
+
+    def update_priorities(self, slots, priorities):
+        """Set the priorities (e.g. absolute TD errors) of sampled slots."""
+
+        priorities = np.asarray(priorities, dtype=float)
+        self.max_priority = max(self.max_priority, float(priorities.max(initial=0.0)))
+        self._set_priorities(np.asarray(slots), priorities**self.alpha)
+
+    def _set_priorities(self, slots, values):
+        node = slots + self.leaves
+        self.tree[node] = values
+
+        node = np.unique(node // 2)
+        while node[0] >= 1:
+            self.tree[node] = self.tree[2*node] + self.tree[2*node + 1]
+            node = np.unique(node // 2)
+
+    def _spill(self, slot):
+        """Write the segment starting at slot, about to be overwritten, to disk."""
+
+        path = os.path.join(self.spill_dir, 'segment_{:08d}.npy'.format(len(self.spilled)))
+        segment = np.lib.format.open_memmap(path, mode='w+', dtype=self.data.dtype,
+                                            shape=(self.segment_size,))
+        segment[:] = self.data[slot:slot + self.segment_size]
+        segment.flush()
+        del segment
+
+        self.spilled.append(path)
+
+    def spilled_segment(self, i):
+        """Read-only memory map of the i-th spilled segment (0 is the oldest)."""
+        return np.load(self.spilled[i], mmap_mode='r')
+
+    def history(self):
+        """All stored transitions, oldest first: the spilled segments followed
+           by the records in memory that are not in them yet.
+
+           Without spill_dir this is the records in memory. This reads the
+           spilled segments into memory."""
+        on_disk = len(self.spilled)*self.segment_size
+        in_memory = self[max(0, on_disk - (self.total - self.size)):]
+        return np.concatenate([self.spilled_segment(i) for i in range(len(self.spilled))] + [in_memory])
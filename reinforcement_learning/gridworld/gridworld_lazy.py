@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Lazy gridworld environment for maps too large to enumerate.
+
+gridworld.Environment stores an occupancy grid, index maps and neighbour
+tables of the whole map, about 50 bytes per cell once compiled. A
+LazyEnvironment stores only the layout description (a set of walls, a dict
+of winds and optionally functions generating them procedurally) and
+computes gridworld_dynamics(state, action, ...) when a state-action pair is
+first visited. The results are kept in a bounded LRU cache, so memory is
+capped by cache_size whatever the size of the grid and only the states the
+agents actually visit are ever touched.
+
+LazyEnvironment.compile() returns a LazyMDP, which provides the sampling
+part of the gridworld_mdp.TabularMDP interface (rewards, terminal states,
+sampling of next states) over cell indices x*height + y, so
+gridworld_vector.VectorEnvironment runs on lazy worlds unchanged. Planning
+needs the full model and is not available.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+import gridworld
+
+
+class LRUCache:
+    """Mapping of at most maxsize entries, evicting the least recently used.
+
+       get(key, compute) returns the cached value of key, or stores and
+       returns compute(key). hits, misses and evictions count the lookups."""
+
+    def __init__(self, maxsize=2**16):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, got {}".format(maxsize))
+
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, compute):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            value = compute(key)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+            return value
+
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def clear(self):
+        self.data.clear()
+
+    def info(self):
+        """Counters and size of the cache as a dict."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self.data), 'maxsize': self.maxsize}
+
+
+class LazyEnvironment(gridworld.Environment):
+    """Gridworld environment computing its dynamics on demand.
+
+       Inputs, in addition to those of gridworld.Environment (except
+       Ptransition, the dynamics are always the default ones):
+       - is_wall: optional function position -> bool marking additional walls,
+         e.g. a procedural map generator
+       - wind_at: optional function position -> Wind or None for winds not
+         listed in winds
+       - cache_size: maximum number of cached (state, action) transition
+         distributions, each one a small dict of at most two positions
+
+       Ptransition is a read-only mapping filled through the cache."""
+
+    def __init__(self,
+                 agent_position = (0,0),
+                 target_position = (4,4),
+                 gridsize    = (4,4),
+                 walls       = [],
+                 winds       = {},
+                 Preward     = "default",
+                 is_wall     = None,
+                 wind_at     = None,
+                 cache_size  = 2**16):
+        """Initialize the environment without enumerating its cells."""
+
+        self.gridsize = tuple(gridsize)
+        self.gridwidth = gridsize[0]
+        self.gridheight = gridsize[1]
+        self.nblocks = gridsize[0]*gridsize[1]
+
+        self.agent_position = agent_position
+        self.state = self.agent_position
+        self.target_position = target_position
+
+        self.walls = walls
+        self.wall_set = set(tuple(wall) for wall in walls)
+        self.winds = winds
+        self.is_wall = is_wall
+        self.wind_at = wind_at
+
+        self.default_reward = Preward == "default"
+        if self.default_reward:
+            self.Preward = lambda agent_action, agent_state: -1
+        else:
+            self.Preward = Preward
+
+        self.default_dynamics = True
+        self.cache = LRUCache(cache_size)
+        self._mdp = None
+
+    @property
+    def statespace(self):
+        raise TypeError("The statespace of a LazyEnvironment is not enumerated")
+
+    @property
+    def Ptransition(self):
+        """Read-only mapping (state, action) -> transition distribution."""
+        return LazyTransitions(self)
+
+    def is_position_allowed(self, position):
+        """Check if a proposed position is allowed."""
+        x, y = position
+
+        if not (0 <= x < self.gridwidth and 0 <= y < self.gridheight):
+            return False
+        if position in self.wall_set:
+            return False
+        if self.is_wall is not None and self.is_wall(position):
+            return False
+
+        return True
+
+    def wind(self, position):
+        """Wind on a position, or None."""
+        wind = self.winds.get(position)
+        if wind is None and self.wind_at is not None:
+            wind = self.wind_at(position)
+        return wind
+
+    def _dynamics(self, key):
+        position, action = key
+        wind = self.wind(position)
+        if wind is None:
+            return self.gridworld_dynamics(position, action)
+        return self.gridworld_dynamics(position, action,
+                                       wind_direction=wind.direction, wind_strength=wind.strength)
+
+    def transitions(self, position, action):
+        """Transition distribution {position: probability} of a state and an
+           action, computed on first access and then cached."""
+        return self.cache.get((tuple(position), tuple(action)), self._dynamics)
+
+    def sample_transition(self, position, action, u):
+        """Next position drawn from transitions(position, action) with the
+           uniform number u in [0, 1)."""
+
+        for new_position, probability in self.transitions(position, action).items():
+            u -= probability
+            if u < 0:
+                return new_position
+        return new_position
+
+    def update(self, action):
+        """Receive agent's action signal, update internal representation,
+        send reward and new state to agent."""
+
+        if tuple(action) not in gridworld.possible_actions:
+            raise gridworld.UnknownActionException("Unknown action '{}'".format(action))
+
+        reward = self.Preward(action, self.agent_position)
+        new_position = self.sample_transition(self.agent_position, action, np.random.random())
+
+        self.agent_position = new_position
+
+        return new_position, reward
+
+    def cache_info(self):
+        """Hit, miss and eviction counters of the transition cache."""
+        return self.cache.info()
+
+    def compile(self):
+        """LazyMDP view of the environment, see the module docstring."""
+        if self._mdp is None:
+            self._mdp = LazyMDP(self)
+        return self._mdp
+
+
+class LazyTransitions:
+    """Read-only Ptransition mapping of a LazyEnvironment."""
+
+    def __init__(self, environment):
+        self.environment = environment
+
+    def __getitem__(self, key):
+        state, action = key
+        if not self.environment.is_position_allowed(tuple(state)):
+            raise KeyError(key)
+        return self.environment.transitions(state, action)
+
+    def __contains__(self, key):
+        try:
+            state, action = key
+        except (TypeError, ValueError):
+            return False
+        return tuple(action) in gridworld.possible_actions and \
+            self.environment.is_position_allowed(tuple(state))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class LazyMDP:
+    """Sampling interface of gridworld_mdp.TabularMDP over a LazyEnvironment.
+
+       States are cell indices x*height + y (walls included, nstates is the
+       number of cells), actions are indices into gridworld.possible_actions.
+       Every draw goes through the environment's transition cache."""
+
+    def __init__(self, environment, actions=gridworld.possible_actions):
+        self.environment = environment
+        self.gridsize = environment.gridsize
+        self.actions = [tuple(action) for action in actions]
+
+    @property
+    def nstates(self):
+        return self.gridsize[0]*self.gridsize[1]
+
+    @property
+    def nactions(self):
+        return len(self.actions)
+
+    def index(self, position):
+        """State index of an (x, y) position."""
+        if not self.environment.is_position_allowed(tuple(position)):
+            raise KeyError("Position {} is not a state".format(position))
+        return int(position[0])*self.gridsize[1] + int(position[1])
+
+    def state(self, index):
+        """(x, y) position of the state with the given index."""
+        return divmod(int(index), self.gridsize[1])
+
+    def lookup(self, x, y):
+        """State indices of the position arrays x, y, -1 outside the grid or on walls."""
+        x, y = np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64)
+        allowed = [self.environment.is_position_allowed(position)
+                   for position in zip(x.ravel().tolist(), y.ravel().tolist())]
+        return np.where(np.reshape(allowed, np.shape(x)), x*self.gridsize[1] + y, -1)
+
+    def locate(self, states):
+        """(x, y) positions of state indices, N x 2."""
+        return np.stack(np.divmod(np.asarray(states, dtype=np.int64), self.gridsize[1]), axis=-1)
+
+    def action_index(self, action):
+        """Index of an action tuple."""
+        try:
+            return self.actions.index(tuple(action))
+        except ValueError:
+            raise gridworld.UnknownActionException("Unknown action '{}'".format(action))
+
+    def reward(self, states, actions):
+        """Rewards of (state, action) index pairs."""
+        states, actions = np.broadcast_arrays(states, actions)
+        if self.environment.default_reward:
+            return np.full(states.shape, float(self.environment.Preward(self.actions[0], (0, 0))))
+        return np.array([self.environment.Preward(self.actions[a], self.state(s))
+                         for s, a in zip(states.ravel().tolist(), actions.ravel().tolist())],
+                        dtype=float).reshape(states.shape)
+
+    def is_terminal(self, states):
+        """True for the states of the target position."""
+        x, y = self.environment.target_position
+        return np.asarray(states) == x*self.gridsize[1] + y
+
+    def sample(self, states, actions, u):
+        """Next states of (state, action) index pairs, one uniform number per pair."""
+
+        height = self.gridsize[1]
+        states, actions, u = np.broadcast_arrays(states, actions, u)
+        sample = self.environment.sample_transition
+
+        out = np.empty(states.shape, dtype=np.int64)
+        flat = out.reshape(-1)
+        for i, (s, a, v) in enumerate(zip(states.ravel().tolist(), actions.ravel().tolist(),
+                                          u.ravel().tolist())):
+            x, y = sample(divmod(s, height), self.actions[a], v)
+            flat[i] = x*height + y
+
+        return out
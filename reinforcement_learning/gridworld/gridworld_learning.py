@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Vectorised tabular Q-learning, SARSA and Expected SARSA.
+
+The action values are an A x S float array over the states and actions of a
+compiled MDP (gridworld_mdp.TabularMDP), action-major like the Q arrays of
+gridworld_planning. A batch of N transitions (s, a, r, s', terminal) is
+applied at once:
+
+    target = r + gamma * (1 - terminal) * bootstrap(s')
+    Q[a, s] += alpha * (target - Q[a, s])
+
+with bootstrap(s') = max_b Q[b, s'] (Q-learning), Q[a', s'] for the next
+action actually chosen (SARSA) or sum_b pi(b | s') Q[b, s'] under the
+behaviour policy (Expected SARSA). All targets are computed from Q before
+the batch. The TD errors of repeated (s, a) pairs are scatter-added per pair
+and averaged, so a batch moves every pair by one step of size alpha however
+many lanes visited it (the lanes of a VectorEnvironment often share their
+start state).
+
+The transitions come from a gridworld_vector.VectorEnvironment, one step of
+all lanes per batch, and the epsilon-greedy or softmax actions of all lanes
+are drawn with a few array operations. Truncated episodes bootstrap from
+their last state, only terminal states have zero value.
+"""
+
+import time
+
+import numpy as np
+
+
+METHODS = ('q_learning', 'sarsa', 'expected_sarsa')
+POLICIES = ('epsilon_greedy', 'softmax')
+
+
+#########################
+## -- Action choice -- ##
+#########################
+
+def epsilon_greedy(Q, states, epsilon, rng):
+    """Greedy action of each state, replaced by a uniformly random action
+       with probability epsilon."""
+
+    actions = Q[:, states].argmax(axis=0)
+    explore = rng.random(len(actions)) < epsilon
+    actions[explore] = rng.integers(0, Q.shape[0], size=int(explore.sum()))
+
+    return actions
+
+
+def softmax_probabilities(Q, states, temperature):
+    """A x N Boltzmann action probabilities exp(Q / temperature) of the states."""
+
+    logits = Q[:, states] / temperature
+    logits -= logits.max(axis=0)
+    p = np.exp(logits)
+    p /= p.sum(axis=0)
+
+    return p
+
+
+def softmax(Q, states, temperature, rng):
+    """Actions drawn from the Boltzmann distribution of each state."""
+
+    cumulative = np.cumsum(softmax_probabilities(Q, states, temperature), axis=0)
+    u = rng.random(len(states)) * cumulative[-1]
+
+    return np.minimum((cumulative < u).sum(axis=0), Q.shape[0] - 1)
+
+
+def epsilon_greedy_probabilities(Q, states, epsilon):
+    """A x N action probabilities of the epsilon-greedy policy."""
+
+    A = Q.shape[0]
+    p = np.full((A, len(states)), epsilon / A)
+    p[Q[:, states].argmax(axis=0), np.arange(len(states))] += 1.0 - epsilon
+
+    return p
+
+
+####################
+## -- Learning -- ##
+####################
+
+class TabularLearner:
+    """Tabular temporal difference learning with batched updates.
+
+       Inputs:
+       - mdp: compiled MDP providing nstates and nactions
+       - method: 'q_learning', 'sarsa' or 'expected_sarsa'
+       - alpha: step size
+       - gamma: discount factor
+       - policy: behaviour policy, 'epsilon_greedy' or 'softmax'
+       - epsilon: exploration rate of the epsilon-greedy policy
+       - temperature: temperature of the softmax policy
+       - Q0: initial action values, a scalar or an A x S array
+       - seed: seed of the action choices
+
+       Q is the A x S array of action values."""
+
+    def __init__(self, mdp, method='q_learning', alpha=0.1, gamma=1.0, policy='epsilon_greedy',
+                 epsilon=0.1, temperature=1.0, Q0=0.0, seed=None):
+
+        if method not in METHODS:
+            raise ValueError("Unknown method '{}', expected one of {}".format(method, METHODS))
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy '{}', expected one of {}".format(policy, POLICIES))
+
+        self.method = method
+        self.alpha = alpha
+        self.gamma = gamma
+        self.policy = policy
+        self.epsilon = epsilon
+        self.temperature = temperature
+        self.rng = np.random.default_rng(seed)
+
+        self.Q = np.empty((mdp.nactions, mdp.nstates))
+        self.Q[...] = Q0
+        self.n_updates = 0
+
+    def act(self, states):
+        """Actions of the behaviour policy in the given states."""
+        if self.policy == 'softmax':
+            return softmax(self.Q, states, self.temperature, self.rng)
+        return epsilon_greedy(self.Q, states, self.epsilon, self.rng)
+
+    def probabilities(self, states):
+        """A x N action probabilities of the behaviour policy."""
+        if self.policy == 'softmax':
+            return softmax_probabilities(self.Q, states, self.temperature)
+        return epsilon_greedy_probabilities(self.Q, states, self.epsilon)
+
+    def greedy_policy(self):
+        """Greedy action index of every state."""
+        return self.Q.argmax(axis=0)
+
+    def update(self, states, actions, rewards, next_states, terminal, next_actions=None):
+        """Apply one batch of transitions, returns the TD errors.
+
+           next_actions are the actions chosen in next_states, only needed
+           (and then required) for SARSA."""
+
+        Q = self.Q
+
+        if self.method == 'q_learning':
+            bootstrap = Q[:, next_states].max(axis=0)
+        elif self.method == 'sarsa':
+            if next_actions is None:
+                raise ValueError("SARSA updates need the next actions")
+            bootstrap = Q[next_actions, next_states]
+        else:
+            bootstrap = (self.probabilities(next_states) * Q[:, next_states]).sum(axis=0)
+
+        td = rewards + self.gamma * np.where(terminal, 0.0, bootstrap) - Q[actions, states]
+
+        pairs, inverse, counts = np.unique(np.asarray(actions)*Q.shape[1] + states,
+                                           return_inverse=True, return_counts=True)
+        Q.flat[pairs] += self.alpha * np.bincount(inverse, weights=td) / counts
+        self.n_updates += len(td)
+
+        return td
+
+    def train(self, env, n_steps):
+        """Learn from n_steps steps of all lanes of a VectorEnvironment.
+
+           Returns an info dict with the number of updates, finished
+           episodes, their mean undiscounted return, the wall time and the
+           updates per second."""
+
+        info = {'updates': 0, 'episodes': 0, 'mean_return': np.nan, 'seconds': 0.0,
+                'updates_per_second': np.nan}
+        returns = np.zeros(env.n_envs)
+        finished = []
+
+        start = time.perf_counter()
+        actions = self.act(env.states)
+
+        for step in range(n_steps):
+            states = env.states
+            next_states, rewards, dones = env.step(actions)
+            terminal = dones & ~env.truncated
+
+            # - Actions of the next step, chosen after the reset of finished
+            # - lanes; SARSA bootstraps finished lanes from their last state
+            next_actions = self.act(env.states)
+            sarsa_actions = None
+            if self.method == 'sarsa':
+                sarsa_actions = next_actions.copy()
+                if dones.any():
+                    sarsa_actions[dones] = self.act(next_states[dones])
+
+            self.update(states, actions, rewards, next_states, terminal, sarsa_actions)
+
+            returns += rewards
+            if dones.any():
+                finished.append(returns[dones].copy())
+                returns[dones] = 0.0
+
+            actions = next_actions
+
+        info['seconds'] = time.perf_counter() - start
+        info['updates'] = n_steps * env.n_envs
+        info['updates_per_second'] = info['updates'] / max(info['seconds'], 1e-12)
+        if finished:
+            finished = np.concatenate(finished)
+            info['episodes'] = len(finished)
+            info['mean_return'] = float(finished.mean())
+
+        return info
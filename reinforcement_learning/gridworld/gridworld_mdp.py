@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Compiled array representation of a gridworld MDP.
+
+gridworld.Environment describes its dynamics with dicts keyed by
+(state_tuple, action_tuple), so every lookup hashes tuples. Here the states
+are numbered by their position in environment.statespace and the actions by
+their position in possible_actions, and the model is stored as
+
+    P_sa        (A*S) x S CSR matrix, row a*S + s is the distribution of the
+                next state after taking action a in state s
+    P[a]        S x S CSR matrix of action a, rows a*S to (a+1)*S of P_sa
+    R           A x S array of rewards, R[a, s] = Preward(action, state)
+    terminal    boolean array of length S, True for absorbing states
+    valid       A x S boolean array, False for the state-action pairs without
+                transitions (the empty rows of P_sa of a partial Ptransition)
+
+so that planning and sampling are sparse matrix products and integer
+indexing. Next states are sampled in O(1) per draw from Walker alias tables
+of the rows of P_sa with several outcomes (see AliasSampler). Arrays over
+state-action pairs are action-major (A x S), so that reductions over the
+actions run over contiguous rows. to_Ptransition() converts back to the dict
+form.
+"""
+
+import numpy as np
+
+import gridworld
+
+
+class AliasSampler:
+    """Walker alias tables of the rows of a sparse transition matrix.
+
+       Rows with a single outcome are sampled directly from the CSR indices,
+       sampling an empty row (a state-action pair without transitions)
+       raises a ValueError.
+       The other rows (e.g. windy states) are padded to the largest number of
+       outcomes K, and column k stores an acceptance threshold prob[t, k] and
+       an alias column. A single uniform number u picks the column
+       c = floor(K u) and, with the fractional part f = K u - c, the outcome
+       of column c if f < prob[t, c] and of its alias otherwise. Sampling is
+       O(1) per draw and vectorised over any number of rows.
+
+       The tables are built for all rows at once: K - 1 times the column with
+       the smallest remaining mass is paired with the one with the largest."""
+
+    def __init__(self, P):
+        self.P = P
+        counts = np.diff(P.indptr)
+
+        # - Row -> table index, -1 for rows with a single outcome, -2 for empty rows
+        branching = np.flatnonzero(counts > 1)
+        self.table = np.full(P.shape[0], -1, dtype=np.int32)
+        self.table[counts == 0] = -2
+        self.table[branching] = np.arange(len(branching), dtype=np.int32)
+
+        # - Padded outcomes and probabilities of the branching rows
+        K = max(int(counts.max(initial=1)), 1)
+        nrows, counts = len(branching), counts[branching]
+        entries = np.repeat(P.indptr[branching], counts) + \
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = np.repeat(np.arange(nrows), counts)
+        column = entries - np.repeat(P.indptr[branching], counts)
+
+        self.outcomes = np.zeros((nrows, K), dtype=P.indices.dtype)
+        self.outcomes[rows, column] = P.indices[entries]
+        q = np.zeros((nrows, K))
+        q[rows, column] = P.data[entries]
+        q *= K / np.maximum(q.sum(1, keepdims=True), 1e-300)
+
+        self.prob = np.ones((nrows, K), dtype=np.float32)
+        self.alias = np.tile(np.arange(K, dtype=np.min_scalar_type(K - 1)), (nrows, 1))
+
+        index = np.arange(nrows)
+        done = np.zeros((nrows, K), dtype=bool)
+        for _ in range(K - 1):
+            small = np.argmin(np.where(done, np.inf, q), axis=1)
+            large = np.argmax(np.where(done, -np.inf, q), axis=1)
+            self.prob[index, small] = q[index, small]
+            self.alias[index, small] = large
+            q[index, large] -= 1.0 - q[index, small]
+            done[index, small] = True
+
+        self.K = K
+
+    def sample(self, rows, u):
+        """Sampled column indices (next states) of the given rows, one uniform
+           number in [0, 1) per row."""
+
+        rows = np.asarray(rows)
+        t = self.table[rows]
+        if np.any(t == -2):
+            raise ValueError("No transitions from row {}".format(rows[t == -2].ravel()[0]))
+        out = self.P.indices[self.P.indptr[rows]]
+
+        branching = t >= 0
+        if np.any(branching):
+            t = t[branching]
+            scaled = np.asarray(u)[branching] * self.K if np.ndim(u) else np.asarray(u) * self.K
+            column = np.minimum(scaled.astype(np.int64), self.K - 1)
+            column = np.where(scaled - column < self.prob[t, column], column, self.alias[t, column])
+            out[branching] = self.outcomes[t, column]
+
+        return out
+
+    def sample_one(self, row, u):
+        """Scalar version of sample() for a single row, without array overhead."""
+
+        t = self.table[row]
+        if t == -2:
+            raise ValueError("No transitions from row {}".format(row))
+        if t < 0:
+            return int(self.P.indices[self.P.indptr[row]])
+
+        scaled = u * self.K
+        column = min(int(scaled), self.K - 1)
+        if scaled - column >= self.prob[t, column]:
+            column = self.alias[t, column]
+
+        return int(self.outcomes[t, column])
+
+
+class TabularMDP:
+    """Finite MDP over gridworld positions with integer state and action indices.
+
+       Inputs:
+       - positions: S x 2 array, positions[s] is the (x, y) position of state s
+       - gridsize: (width, height) of the grid containing the positions
+       - P_sa: (S*A) x S sparse transition matrix, see the module docstring
+       - R: A x S array of rewards
+       - terminal: boolean array of length S marking absorbing states
+       - actions: list of action tuples, the action of index a is actions[a]
+       """
+
+    def __init__(self, positions, gridsize, P_sa, R, terminal=None,
+                 actions=gridworld.possible_actions):
+        from scipy.sparse import csr_matrix
+
+        self.positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        self.gridsize = tuple(gridsize)
+        self.actions = [tuple(action) for action in actions]
+        self.P_sa = csr_matrix(P_sa)
+        self.R = np.asarray(R, dtype=float).reshape(self.nactions, self.nstates)
+
+        if terminal is None:
+            terminal = np.zeros(self.nstates, dtype=bool)
+        self.terminal = np.asarray(terminal, dtype=bool)
+
+        # - Position -> state index lookup, -1 for positions that are not states
+        self.index_map = np.full(self.gridsize, -1, dtype=np.int64)
+        self.index_map[self.positions[:,0], self.positions[:,1]] = np.arange(self.nstates)
+
+        if self.P_sa.shape != (self.nactions*self.nstates, self.nstates):
+            raise ValueError("P_sa has shape {}, expected {}".format(
+                self.P_sa.shape, (self.nactions*self.nstates, self.nstates)))
+
+        self.valid = (np.diff(self.P_sa.indptr) > 0).reshape(self.nactions, self.nstates)
+
+        self._P = None
+        self._sampler = None
+
+    @property
+    def nstates(self):
+        return len(self.positions)
+
+    @property
+    def nactions(self):
+        return len(self.actions)
+
+    @property
+    def P(self):
+        """List of the S x S transition matrices of each action."""
+        if self._P is None:
+            S = self.nstates
+            self._P = [self.P_sa[a*S:(a+1)*S] for a in range(self.nactions)]
+        return self._P
+
+    @property
+    def sampler(self):
+        """AliasSampler of P_sa, built on first use."""
+        if self._sampler is None:
+            self._sampler = AliasSampler(self.P_sa)
+        return self._sampler
+
+    def sample(self, states, actions, u):
+        """Next states of (state, action) index pairs, one uniform number per pair."""
+        return self.sampler.sample(np.asarray(actions)*self.nstates + states, u)
+
+    def index(self, position):
+        """State index of an (x, y) position."""
+        x, y = position
+        if not (0 <= x < self.gridsize[0] and 0 <= y < self.gridsize[1]) or self.index_map[x, y] < 0:
+            raise KeyError("Position {} is not a state".format(position))
+        return int(self.index_map[x, y])
+
+    def state(self, index):
+        """(x, y) position of the state with the given index."""
+        return tuple(int(v) for v in self.positions[index])
+
+    def lookup(self, x, y):
+        """State indices of the position arrays x, y, -1 outside the grid or on walls."""
+        x, y = np.asarray(x), np.asarray(y)
+        inside = (x >= 0) & (x < self.gridsize[0]) & (y >= 0) & (y < self.gridsize[1])
+        index = np.full(np.shape(x), -1, dtype=np.int64)
+        index[inside] = self.index_map[x[inside], y[inside]]
+        return index
+
+    def locate(self, states):
+        """(x, y) positions of state indices, N x 2."""
+        return self.positions[states]
+
+    def reward(self, states, actions):
+        """Rewards of (state, action) index pairs."""
+        return self.R[actions, states]
+
+    def is_terminal(self, states):
+        """True for absorbing states."""
+        return self.terminal[states]
+
+    def to_grid(self, values, fill=np.nan):
+        """Per-state values (length S) as a width x height array, fill on walls."""
+        grid = np.full(self.gridsize + np.shape(values)[1:], fill, dtype=float)
+        grid[self.positions[:,0], self.positions[:,1]] = values
+        return grid
+
+    def action_index(self, action):
+        """Index of an action tuple."""
+        try:
+            return self.actions.index(tuple(action))
+        except ValueError:
+            raise gridworld.UnknownActionException("Unknown action '{}'".format(action))
+
+    @classmethod
+    def from_environment(cls, environment, terminal_states=None):
+        """Compile the dynamics and Preward of a gridworld.Environment.
+
+           The default dynamics are assembled directly from the environment's
+           neighbour tables, a custom Ptransition dict is read entry by entry.
+           terminal_states is a list of absorbing positions, by default the
+           target position of the environment."""
+
+        actions = gridworld.possible_actions
+        positions = environment.positions
+        index_map = environment.state_index
+        A, S = len(actions), len(positions)
+
+        if environment.default_dynamics:
+            P_sa = cls._default_transitions(environment)
+        else:
+            P_sa = cls._dict_transitions(environment)
+
+        if environment.default_reward:
+            R = np.full((A, S), float(environment.Preward(actions[0], environment.agent_position)))
+        else:
+            R = np.empty((A, S))
+            for s, state in enumerate(environment.statespace):
+                for a, action in enumerate(actions):
+                    R[a, s] = environment.Preward(action, state)
+
+        if terminal_states is None:
+            terminal_states = [environment.target_position]
+        terminal = np.zeros(S, dtype=bool)
+        for position in terminal_states:
+            x, y = position
+            if 0 <= x < index_map.shape[0] and 0 <= y < index_map.shape[1] and index_map[x, y] >= 0:
+                terminal[index_map[x, y]] = True
+
+        return cls(positions, environment.gridsize, P_sa, R, terminal, actions)
+
+    @staticmethod
+    def _dict_transitions(environment):
+        """P_sa from the Ptransition dict of an environment.
+
+           State-action pairs missing from the dict give empty rows, which
+           only raise an error when they are sampled."""
+        from scipy.sparse import csr_matrix
+
+        index_map = environment.state_index
+        actions = gridworld.possible_actions
+        A, S = len(actions), len(environment.positions)
+        rows, cols, data = [], [], []
+
+        for s, state in enumerate(environment.statespace):
+            for a, action in enumerate(actions):
+                transitions = environment.Ptransition.get((state, action), {})
+                for new_state, probability in transitions.items():
+                    x, y = new_state
+                    if not (0 <= x < index_map.shape[0] and 0 <= y < index_map.shape[1]) \
+                            or index_map[x, y] < 0:
+                        raise ValueError("Transition from {} to {} leaves the statespace".format(
+                            state, new_state))
+                    rows.append(a*S + s)
+                    cols.append(index_map[x, y])
+                    data.append(probability)
+
+        return csr_matrix((data, (rows, cols)), shape=(A*S, S))
+
+    @staticmethod
+    def _default_transitions(environment):
+        """P_sa of the default dynamics (see Environment.gridworld_dynamics)
+           from the neighbour tables, without going through dicts.
+
+           A move into a wall or off the grid is dropped; in a windy state
+           the intended move has probability 1 - strength and the wind shifted
+           one strength, renormalised over the allowed ones; if no move is
+           allowed the agent stays."""
+        from scipy.sparse import csr_matrix
+
+        neighbours = environment.neighbours
+        windy, strengths, shifted = environment.wind_neighbours
+        A, S = neighbours.shape
+
+        stay = np.arange(S, dtype=np.int32)
+        first = np.where(neighbours < 0, stay, neighbours)
+
+        # - Windy states: two outcomes if both moves are allowed and distinct
+        intended = neighbours[:, windy]
+        two = (intended >= 0) & (shifted >= 0) & (shifted != intended)
+        first[:, windy] = np.where(intended >= 0, intended,
+                                   np.where(shifted >= 0, shifted, stay[windy]))
+
+        counts = np.ones((A, S), dtype=np.int32)
+        counts[:, windy] += two
+
+        indptr = np.zeros(A*S + 1, dtype=np.int64)
+        np.cumsum(counts.ravel(), out=indptr[1:])
+        index_dtype = np.int32 if indptr[-1] < 2**31 else np.int64
+
+        starts = indptr[:-1].reshape(A, S)
+        indices = np.empty(indptr[-1], dtype=index_dtype)
+        data = np.ones(indptr[-1])
+        indices[starts.ravel()] = first.ravel()
+
+        a, j = np.nonzero(two)
+        start = starts[a, windy[j]]
+        indices[start + 1] = shifted[a, j]
+        data[start] = 1.0 - strengths[j]
+        data[start + 1] = strengths[j]
+
+        return csr_matrix((data, indices, indptr.astype(index_dtype)), shape=(A*S, S))
+
+    def to_Ptransition(self):
+        """Transition probabilities in the dict form used by gridworld.Environment."""
+
+        Ptransition = {}
+        indptr, indices, data = self.P_sa.indptr, self.P_sa.indices, self.P_sa.data
+
+        for s in range(self.nstates):
+            state = self.state(s)
+            for a, action in enumerate(self.actions):
+                row = a*self.nstates + s
+                if indptr[row] == indptr[row+1]:
+                    continue
+                Ptransition[(state, action)] = {
+                    self.state(j): float(p)
+                    for j, p in zip(indices[indptr[row]:indptr[row+1]], data[indptr[row]:indptr[row+1]])}
+
+        return Ptransition
+
+    def to_dense(self):
+        """A x S x S dense array of the transition matrices."""
+        return self.P_sa.toarray().reshape(self.nactions, self.nstates, self.nstates)
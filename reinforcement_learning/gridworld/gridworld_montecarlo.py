@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Parallel Monte Carlo policy evaluation on a compiled gridworld MDP.
+
+Episodes are split into chunks of chunk_size episodes. Chunk i draws all
+its random numbers (actions and transitions) from the i-th child of
+numpy.random.SeedSequence(seed), rolls out its episodes as one batch of
+lanes over the compiled MDP (see gridworld_mdp.TabularMDP) and computes the
+discounted return G_t = r_t + gamma G_t+1 of every visit with one backward
+pass. The chunks run in a process pool and their statistics are merged in
+chunk order, so the result does not depend on the number of workers.
+
+Per-state returns (first-visit or every-visit) and episode returns are
+aggregated as count, mean and sum of squared deviations, merged with the
+parallel form of Welford's update (RunningStats), and reported with normal
+confidence intervals and throughput statistics. The intervals treat the
+samples as independent, which holds for first-visit returns; the repeated
+visits of an episode are correlated, so every-visit intervals are too
+narrow.
+"""
+
+import math
+import os
+import statistics
+import time
+
+import numpy as np
+
+
+class RunningStats:
+    """Streaming count, mean and variance of the samples of n quantities."""
+
+    def __init__(self, n):
+        self.count = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n)
+        self.M2 = np.zeros(n)
+
+    def merge(self, index, count, mean, M2):
+        """Merge the statistics of a batch of samples of the quantities index."""
+
+        n_a = self.count[index]
+        n = n_a + count
+        delta = mean - self.mean[index]
+
+        self.mean[index] += delta * count / n
+        self.M2[index] += M2 + delta**2 * n_a * count / n
+        self.count[index] = n
+
+    @property
+    def variance(self):
+        """Unbiased sample variance, NaN with fewer than two samples."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.M2 / np.maximum(self.count - 1, 1), np.nan)
+
+    def confidence_interval(self, confidence=0.95):
+        """Normal confidence intervals (low, high) of the means."""
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence/2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            half = z * np.sqrt(self.variance / self.count)
+        return self.mean - half, self.mean + half
+
+
+def batch_stats(keys, values):
+    """Count, mean and sum of squared deviations of values grouped by keys.
+       Returns (unique keys, count, mean, M2)."""
+
+    index, inverse = np.unique(keys, return_inverse=True)
+    count = np.bincount(inverse, minlength=len(index))
+    mean = np.bincount(inverse, weights=values, minlength=len(index)) / count
+    M2 = np.bincount(inverse, weights=(values - mean[inverse])**2, minlength=len(index))
+
+    return index, count, mean, M2
+
+
+def rollout_chunk(mdp, cumulative, start, n_episodes, gamma, max_steps, first_visit, seed):
+    """Roll out n_episodes episodes from the state index start.
+
+       cumulative is the A x S cumulative sum over the actions of the policy
+       probabilities, seed a SeedSequence. Returns the per-state and episode
+       return statistics of the chunk and its number of steps and truncated
+       episodes."""
+
+    rng = np.random.default_rng(seed)
+    A, S = cumulative.shape
+
+    states = np.full(n_episodes, start, dtype=np.int64)
+    active = np.full(n_episodes, not mdp.terminal[start])
+    visits, rewards, alive = [], [], []
+
+    for t in range(max_steps):
+        lanes = np.flatnonzero(active)
+        if len(lanes) == 0:
+            break
+
+        s = states[lanes]
+        u = rng.random((2, len(lanes)))
+        a = np.minimum((cumulative[:, s] < u[0]*cumulative[-1, s]).sum(axis=0), A - 1)
+
+        reward = np.zeros(n_episodes)
+        reward[lanes] = mdp.R[a, s]
+        visits.append(states.copy())
+        rewards.append(reward)
+        alive.append(active.copy())
+
+        states[lanes] = mdp.sample(s, a, u[1])
+        active[lanes] = ~mdp.terminal[states[lanes]]
+
+    # - Discounted returns of every step, backwards
+    T = len(visits)
+    returns = np.zeros((T, n_episodes))
+    G = np.zeros(n_episodes)
+    for t in range(T - 1, -1, -1):
+        G = rewards[t] + gamma*G
+        returns[t] = G
+
+    visits = np.array(visits, dtype=np.int64).reshape(T, n_episodes)
+    alive = np.array(alive, dtype=bool).reshape(T, n_episodes)
+
+    # - Visits in time order; the first visit of a state in an episode is
+    # - the first occurrence of its (episode, state) key
+    t, lane = np.nonzero(alive)
+    keys = visits[t, lane]
+    values = returns[t, lane]
+    if first_visit:
+        _, first = np.unique(lane*S + keys, return_index=True)
+        keys, values = keys[first], values[first]
+
+    episode_returns = returns[0] if T else np.zeros(n_episodes)
+
+    return {'states': batch_stats(keys, values),
+            'episodes': batch_stats(np.zeros(n_episodes, dtype=np.int64), episode_returns),
+            'steps': int(alive.sum()),
+            'truncated': int(active.sum())}
+
+
+# - Per worker process model, set once by the pool initializer
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _run_chunk(task):
+    return rollout_chunk(*_worker_args, *task)
+
+
+def monte_carlo_evaluation(mdp, policy, start, n_episodes, gamma=1.0, max_steps=10000,
+                           first_visit=True, n_workers=None, chunk_size=1024, seed=None,
+                           confidence=0.95):
+    """Monte Carlo estimate of the value of a policy.
+
+       Inputs:
+       - mdp: compiled gridworld_mdp.TabularMDP
+       - policy: any policy accepted by gridworld_planning.policy_matrix
+       - start: (x, y) position where every episode starts
+       - n_episodes: number of episodes
+       - gamma: discount factor
+       - max_steps: episodes still running after max_steps are truncated
+       - first_visit: first-visit (True) or every-visit returns
+       - n_workers: processes of the pool (default: all cores, 1: no pool)
+       - chunk_size: episodes per chunk, the unit of work and of seeding;
+         a chunk keeps chunk_size x (episode length) arrays in memory
+       - seed: seed of the SeedSequence, results only depend on it and on
+         chunk_size
+       - confidence: level of the confidence intervals
+
+       Returns a dict with the per-state value estimates, sample counts,
+       variances and confidence intervals (NaN for unvisited states), the
+       same statistics of the episode return, and the number of episodes,
+       steps, truncated episodes, seconds, episodes and steps per second."""
+    import concurrent.futures
+    import gridworld_planning
+
+    pi = gridworld_planning.policy_matrix(mdp, policy)
+    gridworld_planning.check_policy(mdp, pi)
+    cumulative = np.cumsum(pi, axis=0)
+    start = mdp.index(start)
+
+    sequence = np.random.SeedSequence(seed)
+    n_chunks = math.ceil(n_episodes / chunk_size)
+    tasks = [(start, min(chunk_size, n_episodes - i*chunk_size), gamma, max_steps, first_visit, child)
+             for i, child in enumerate(sequence.spawn(n_chunks))]
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, n_chunks))
+
+    begin = time.perf_counter()
+    if n_workers == 1:
+        chunks = [rollout_chunk(mdp, cumulative, *task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_workers, initializer=_init_worker,
+                                                    initargs=(mdp, cumulative)) as pool:
+            chunks = list(pool.map(_run_chunk, tasks))
+    seconds = time.perf_counter() - begin
+
+    # - Merge in chunk order, independently of the completion order
+    state_stats, episode_stats = RunningStats(mdp.nstates), RunningStats(1)
+    steps = truncated = 0
+    for chunk in chunks:
+        state_stats.merge(*chunk['states'])
+        episode_stats.merge(*chunk['episodes'])
+        steps += chunk['steps']
+        truncated += chunk['truncated']
+
+    visited = state_stats.count > 0
+    low, high = state_stats.confidence_interval(confidence)
+    episode_low, episode_high = episode_stats.confidence_interval(confidence)
+
+    return {'value': np.where(visited, state_stats.mean, np.nan),
+            'count': state_stats.count,
+            'variance': state_stats.variance,
+            'ci_low': low, 'ci_high': high,
+            'episode_return': float(episode_stats.mean[0]),
+            'episode_variance': float(episode_stats.variance[0]),
+            'episode_ci': (float(episode_low[0]), float(episode_high[0])),
+            'episodes': n_episodes, 'steps': steps, 'truncated': truncated,
+            'workers': n_workers, 'seed': sequence.entropy, 'seconds': seconds,
+            'episodes_per_second': n_episodes / max(seconds, 1e-12),
+            'steps_per_second': steps / max(seconds, 1e-12)}
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+Dynamic programming on a compiled gridworld MDP (see gridworld_mdp.py).
+
+Every sweep is one sparse matrix-vector product with the (A*S) x S
+transition matrix,
+
+    Q = R + gamma * (P_sa V).reshape(A, S),
+
+followed by a reduction over the A contiguous rows of Q, so a sweep over a
+1000 x 1000 grid with 8 actions costs a few times the memory traffic of
+P_sa. Terminal states are absorbing with zero value.
+
+DirectPolicyEvaluator solves (I - gamma P_pi) V = r_pi exactly with a
+sparse LU factorisation, which does not slow down as gamma approaches 1.
+Policies that differ from the factorised one in a few states are solved
+with low-rank (Woodbury) updates of the same factorisation.
+
+Policies are A x S arrays of action probabilities; policy_matrix() converts
+action index arrays, dicts and callables. State-action pairs without
+transitions (mdp.valid is False, from a partial Ptransition dict) have
+Q = -inf, and policies may not choose them, except in terminal states and in
+states where no action is defined. All solvers return an info dict
+with the number of sweeps, the residual max |V_new - V| and the wall time of
+every sweep.
+"""
+
+import time
+import warnings
+
+import numpy as np
+
+import gridworld
+
+
+##################
+## -- Policy -- ##
+##################
+
+def uniform_policy(mdp):
+    """Policy choosing every defined action with equal probability."""
+    allowed = mdp.valid | ~undefined_actions(mdp).any(axis=0)
+    return allowed / allowed.sum(axis=0)
+
+
+def undefined_actions(mdp):
+    """A x S mask of the state-action pairs a policy may not choose: pairs
+       without transitions in non-terminal states that have a defined action."""
+    return ~mdp.valid & mdp.valid.any(axis=0) & ~mdp.terminal
+
+
+def check_policy(mdp, pi):
+    """Raise a ValueError if the A x S policy pi chooses an undefined action."""
+
+    a, s = np.nonzero((pi > 0) & undefined_actions(mdp))
+    if len(s):
+        raise ValueError("The policy chooses action {} in state {}, which has no transitions".format(
+            mdp.actions[a[0]], mdp.state(s[0])))
+
+
+def policy_matrix(mdp, policy):
+    """A x S array of action probabilities from:
+
+       - an A x S array of probabilities (returned as is)
+       - an array of S action indices (deterministic policy)
+       - a dict {state_tuple: action_tuple or list of A probabilities}
+       - a function state_tuple -> action_tuple, called once per state, so
+         it must be deterministic. gridworld.random_policy, which draws a new
+         action at every call, is read as the uniform policy over its actions"""
+
+    if isinstance(policy, dict):
+        pi = np.zeros((mdp.nactions, mdp.nstates))
+        for state, value in policy.items():
+            s = mdp.index(state)
+            if len(value) == mdp.nactions:
+                pi[:, s] = value
+            else:
+                pi[mdp.action_index(value), s] = 1.0
+        return pi
+
+    if policy is gridworld.random_policy:
+        pi = np.zeros((mdp.nactions, mdp.nstates))
+        for action in gridworld.possible_actions:
+            pi[mdp.action_index(action)] += 1.0/len(gridworld.possible_actions)
+        return pi
+
+    if callable(policy):
+        policy = [mdp.action_index(policy(mdp.state(s))) for s in range(mdp.nstates)]
+
+    policy = np.asarray(policy)
+    if policy.ndim == 2:
+        return policy.astype(float)
+
+    pi = np.zeros((mdp.nactions, mdp.nstates))
+    pi[policy, np.arange(mdp.nstates)] = 1.0
+    return pi
+
+
+def policy_model(mdp, policy):
+    """Transition matrix P_pi (S x S CSR) and expected rewards r_pi of a policy.
+
+       The rows of terminal states are zero, so their value stays zero."""
+    from scipy.sparse import coo_matrix, diags
+
+    pi = policy_matrix(mdp, policy)
+    check_policy(mdp, pi)
+    A, S = pi.shape
+
+    # - Pi is S x (A*S) with Pi[s, a*S + s] = pi[a, s], so P_pi = Pi P_sa
+    a, s = np.nonzero(pi)
+    Pi = coo_matrix((pi[a, s], (s, a*S + s)), shape=(S, A*S)).tocsr()
+    live = (~mdp.terminal).astype(float)
+
+    P_pi = (diags(live) @ (Pi @ mdp.P_sa)).tocsr()
+    r_pi = live * np.einsum('ij,ij->j', pi, mdp.R)
+
+    return P_pi, r_pi
+
+
+def action_values(mdp, V, gamma=1.0):
+    """A x S array Q = R + gamma P V, zero in terminal states and -inf for
+       undefined actions."""
+
+    Q = (mdp.P_sa @ V).reshape(mdp.nactions, mdp.nstates)
+    if gamma != 1:
+        Q *= gamma
+    Q += mdp.R
+    Q[undefined_actions(mdp)] = -np.inf
+    Q[:, mdp.terminal] = 0.0
+
+    return Q
+
+
+def greedy_policy(mdp, V, gamma=1.0, policy=None, tol=1e-12):
+    """Action indices maximising Q. If a previous deterministic policy is
+       given, its action is kept unless another one is better by more than
+       tol, so that policy iteration does not cycle between ties."""
+
+    Q = action_values(mdp, V, gamma)
+    greedy = np.argmax(Q, axis=0)
+
+    if policy is not None:
+        states = np.arange(mdp.nstates)
+        policy = np.asarray(policy)
+        keep = Q[policy, states] >= Q[greedy, states] - tol
+        greedy[keep] = policy[keep]
+
+    return greedy
+
+
+###################
+## -- Solvers -- ##
+###################
+
+class DirectPolicyEvaluator:
+    """Exact policy evaluation with a cached sparse LU factorisation.
+
+       Inputs:
+       - mdp: compiled gridworld_mdp.TabularMDP
+       - gamma: discount factor
+       - max_rank: largest number of changed states handled by a low-rank update
+       - max_bytes: memory budget of the S x k low-rank update
+
+       evaluate(policy) factorises A0 = I - gamma P_pi0 on the first call.
+       For a later policy that differs from pi0 in the k states E, only those
+       rows change, A = A0 + E D, and Woodbury's identity
+
+           A^-1 b = y - Z (I + D Z)^-1 D y,   y = A0^-1 b,  Z = A0^-1 E
+
+       needs k + 1 solves with the existing factors instead of a new
+       factorisation. When k exceeds the rank limit the new A is factorised
+       and becomes the reference. scipy's SuperLU cannot reuse a symbolic
+       factorisation with new values, so this is the reuse available.
+
+       The counters n_factorisations and n_updates and the rank of the
+       last update are kept as attributes."""
+
+    def __init__(self, mdp, gamma=1.0, max_rank=64, max_bytes=64*2**20):
+        self.mdp = mdp
+        self.gamma = gamma
+        self.max_rank = max_rank
+        self.max_bytes = max_bytes
+
+        self.factor = None
+        self.n_factorisations = 0
+        self.n_updates = 0
+        self.rank = 0
+
+    def _rows(self, pi, states):
+        """Rows of I - gamma P_pi for the given states, as a sparse matrix."""
+        from scipy.sparse import coo_matrix
+
+        S = self.mdp.nstates
+        weights = pi[:, states] * ~self.mdp.terminal[states]
+        a, i = np.nonzero(weights)
+        Pi = coo_matrix((weights[a, i], (i, a*S + states[i])), shape=(len(states), self.mdp.nactions*S))
+        E = coo_matrix((np.ones(len(states)), (np.arange(len(states)), states)), shape=(len(states), S))
+
+        return (E - self.gamma*(Pi.tocsr() @ self.mdp.P_sa)).tocsr()
+
+    def factorise(self, policy):
+        """Factorise I - gamma P_pi and make policy the reference for updates."""
+        from scipy.sparse import identity
+        from scipy.sparse.linalg import splu
+
+        P_pi, r_pi = policy_model(self.mdp, policy)
+        self.policy = policy_matrix(self.mdp, policy)
+
+        # - I - gamma P_pi is diagonally dominant, so no pivoting is needed
+        matrix = (identity(self.mdp.nstates, format='csc') - self.gamma*P_pi).tocsc()
+        self.factor = splu(matrix, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.0,
+                           options=dict(SymmetricMode=True))
+        self.n_factorisations += 1
+        self.rank = 0
+
+        return r_pi
+
+    def evaluate(self, policy):
+        """Value function of policy, an S vector."""
+
+        limit = min(self.max_rank, self.max_bytes // (8*self.mdp.nstates))
+        pi = policy_matrix(self.mdp, policy)
+        check_policy(self.mdp, pi)
+
+        changed = None
+        if self.factor is not None:
+            changed = np.flatnonzero(np.any(pi != self.policy, axis=0))
+
+        if changed is None or len(changed) > limit:
+            r_pi = self.factorise(pi)
+            return self.factor.solve(r_pi)
+
+        r_pi = ~self.mdp.terminal * np.einsum('ij,ij->j', pi, self.mdp.R)
+        y = self.factor.solve(r_pi)
+        self.rank = len(changed)
+        if self.rank == 0:
+            return y
+
+        # - Low-rank correction for the rows of the changed states
+        D = (self._rows(pi, changed) - self._rows(self.policy, changed)).toarray()
+        E = np.zeros((self.mdp.nstates, self.rank))
+        E[changed, np.arange(self.rank)] = 1.0
+        Z = self.factor.solve(E)
+
+        C = np.dot(D, Z)
+        C[np.diag_indices_from(C)] += 1.0
+        self.n_updates += 1
+
+        return y - np.dot(Z, np.linalg.solve(C, np.dot(D, y)))
+
+
+def _new_info():
+    return {'iterations': 0, 'converged': False, 'residuals': [], 'sweep_times': []}
+
+
+def value_iteration(mdp, gamma=1.0, tol=1e-6, max_iter=10000, V0=None):
+    """Synchronous value iteration V <- max_a (R + gamma P V).
+
+       Stops when max |V_new - V| <= tol or after max_iter sweeps.
+       Returns (V, greedy policy as action indices, info)."""
+
+    V = np.zeros(mdp.nstates) if V0 is None else np.array(V0, dtype=float)
+    info = _new_info()
+
+    # - If the rewards do not depend on the action (as the default -1 per
+    # - step), they are added after the maximum over A x S values
+    state_reward = None
+    if np.all(mdp.R == mdp.R[0]):
+        state_reward = np.where(mdp.terminal, 0.0, mdp.R[0])
+        undefined = undefined_actions(mdp)
+
+    for iteration in range(max_iter):
+        start = time.perf_counter()
+        if state_reward is None:
+            V_new = action_values(mdp, V, gamma).max(axis=0)
+        else:
+            Q = (mdp.P_sa @ V).reshape(mdp.nactions, mdp.nstates)
+            Q[undefined] = -np.inf
+            V_new = Q.max(axis=0)
+            V_new *= gamma
+            V_new[mdp.terminal] = 0.0
+            V_new += state_reward
+        residual = np.max(np.abs(V_new - V), initial=0.0)
+        V = V_new
+        info['sweep_times'].append(time.perf_counter() - start)
+        info['residuals'].append(residual)
+
+        if residual <= tol:
+            info['converged'] = True
+            break
+
+    info['iterations'] = len(info['residuals'])
+    if not info['converged']:
+        warnings.warn("Value iteration did not converge in {} sweeps, residual {:.2e}".format(
+            max_iter, info['residuals'][-1]))
+
+    return V, greedy_policy(mdp, V, gamma), info
+
+
+def policy_evaluation(mdp, policy, gamma=1.0, tol=1e-6, max_iter=10000, V0=None):
+    """Iterative policy evaluation V <- r_pi + gamma P_pi V.
+
+       Stops when max |V_new - V| <= tol or after max_iter sweeps.
+       Returns (V, info)."""
+
+    P_pi, r_pi = policy_model(mdp, policy)
+    V = np.zeros(mdp.nstates) if V0 is None else np.array(V0, dtype=float)
+    info = _new_info()
+
+    for iteration in range(max_iter):
+        start = time.perf_counter()
+        V_new = P_pi @ V
+        V_new *= gamma
+        V_new += r_pi
+        residual = np.max(np.abs(V_new - V), initial=0.0)
+        V = V_new
+        info['sweep_times'].append(time.perf_counter() - start)
+        info['residuals'].append(residual)
+
+        if residual <= tol:
+            info['converged'] = True
+            break
+
+    info['iterations'] = len(info['residuals'])
+    if not info['converged']:
+        warnings.warn("Policy evaluation did not converge in {} sweeps, residual {:.2e}".format(
+            max_iter, info['residuals'][-1]))
+
+    return V, info
+
+
+def policy_iteration(mdp, gamma=1.0, policy=None, tol=1e-6, max_iter=100, eval_max_iter=10000,
+                     method='iterative', max_rank=64):
+    """Policy iteration: alternate policy evaluation and greedy improvement
+       until the policy is stable.
+
+       With method='iterative' each evaluation is iterative and warm started
+       from the previous value function; with method='direct' it is exact,
+       using a DirectPolicyEvaluator whose factorisation is updated between
+       steps that change at most max_rank states. The initial policy
+       (default: uniform random) must reach a terminal state when gamma = 1.
+
+       Returns (V, policy as action indices, info) where info also lists the
+       evaluation sweeps and the number of states whose action changed at
+       every step."""
+
+    if method not in ('iterative', 'direct'):
+        raise ValueError("Unknown policy evaluation method '{}'".format(method))
+
+    pi = uniform_policy(mdp) if policy is None else policy
+    V = None
+    current = None
+    info = _new_info()
+    info.update(evaluation_sweeps=[], changed=[])
+
+    if method == 'direct':
+        evaluator = DirectPolicyEvaluator(mdp, gamma, max_rank)
+
+    for iteration in range(max_iter):
+        start = time.perf_counter()
+        if method == 'direct':
+            V = evaluator.evaluate(pi)
+            evaluation = {'iterations': 0, 'residuals': []}
+        else:
+            V, evaluation = policy_evaluation(mdp, pi, gamma, tol, eval_max_iter, V0=V)
+        improved = greedy_policy(mdp, V, gamma, current)
+        changed = mdp.nstates if current is None else int(np.count_nonzero(improved != current))
+
+        info['sweep_times'].append(time.perf_counter() - start)
+        info['evaluation_sweeps'].append(evaluation['iterations'])
+        info['changed'].append(changed)
+        info['residuals'].append(evaluation['residuals'][-1] if evaluation['residuals'] else 0.0)
+
+        current = pi = improved
+        if changed == 0:
+            info['converged'] = True
+            break
+
+    info['iterations'] = len(info['changed'])
+    if method == 'direct':
+        info.update(factorisations=evaluator.n_factorisations, low_rank_updates=evaluator.n_updates)
+    if not info['converged']:
+        warnings.warn("Policy iteration did not converge in {} steps".format(max_iter))
+
+    return V, current, info
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Batched gridworld environment stepping many agents at once.
+
+VectorEnvironment keeps the states of N agents (lanes) as an integer array
+over the compiled MDP of a gridworld.Environment (see gridworld_mdp.py), so
+one step of all lanes is a handful of NumPy operations: look up the rewards
+R[a, s], draw one uniform number per lane and pick the next state from the
+alias table of row a*S + s of P_sa (gridworld_mdp.AliasSampler). The model
+is only used through its index, reward, is_terminal, sample and locate
+methods, so the cached LazyMDP of a gridworld_lazy.LazyEnvironment works too.
+
+The random numbers come from a counter-based generator (the SplitMix64
+sequence): lane i draws the t-th number of a stream keyed by the seed and i,
+so a lane's trajectory only depends on the seed, its index and its own
+actions, and not on the number of lanes or on the other lanes.
+"""
+
+import numpy as np
+
+
+# - SplitMix64 constants
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def splitmix64(x):
+    """SplitMix64 finaliser of a uint64 array, a bijective hash."""
+    z = np.asarray(x, dtype=np.uint64).copy()
+    z ^= z >> np.uint64(30)
+    z *= _MIX1
+    z ^= z >> np.uint64(27)
+    z *= _MIX2
+    z ^= z >> np.uint64(31)
+    return z
+
+
+class LaneRandom:
+    """Independent reproducible uniform streams, one per lane.
+
+       Lane i of seed s always produces the same sequence, whatever the
+       number of lanes. The draws of a subset of lanes only advance those
+       lanes."""
+
+    def __init__(self, n_lanes, seed=None):
+        self.seed = np.random.SeedSequence(seed).entropy
+        base = np.random.SeedSequence(self.seed).generate_state(1, np.uint64)[0]
+
+        self.keys = splitmix64(np.uint64(base) ^ splitmix64(np.arange(n_lanes, dtype=np.uint64)))
+        self.counters = np.zeros(n_lanes, dtype=np.uint64)
+
+    def random(self, lanes=None):
+        """One uniform number in [0, 1) for every lane (or the given lanes)."""
+
+        if lanes is None:
+            lanes = slice(None)
+
+        self.counters[lanes] += np.uint64(1)
+        bits = splitmix64(self.keys[lanes] + self.counters[lanes]*_GOLDEN)
+
+        return (bits >> np.uint64(11)) * 2.0**-53
+
+
+class VectorEnvironment:
+    """N copies of a gridworld environment stepped together.
+
+       Inputs:
+       - environment: gridworld.Environment providing the dynamics, walls,
+         winds and rewards (through its compiled MDP)
+       - n_envs: number of lanes
+       - start: start position of every lane, or a list of N positions
+         (default: the environment's agent position)
+       - seed: seed of the per-lane random streams
+       - max_steps: episodes are truncated after this many steps
+
+       Actions and states are integer indices, see gridworld_mdp.TabularMDP
+       (or gridworld_lazy.LazyMDP for a LazyEnvironment).
+       Lanes whose episode ends (terminal state or truncation) are put back
+       at their start state before the next step."""
+
+    def __init__(self, environment, n_envs, start=None, seed=None, max_steps=None):
+        self.mdp = environment.compile()
+        self.n_envs = n_envs
+        self.max_steps = max_steps
+        self.random = LaneRandom(n_envs, seed)
+
+        if start is None:
+            start = environment.agent_position
+        start = np.asarray(start)
+        if start.ndim == 1:
+            start = np.broadcast_to(start, (n_envs, 2))
+        self.start = self.mdp.lookup(start[:,0], start[:,1])
+        if np.any(self.start < 0):
+            raise ValueError("Start positions must be states of the environment")
+
+        self.reset()
+
+    def reset(self, lanes=None):
+        """Put the given lanes (default: all) back at their start state."""
+
+        if lanes is None:
+            self.states = self.start.copy()
+            self.steps = np.zeros(self.n_envs, dtype=np.int64)
+        else:
+            self.states[lanes] = self.start[lanes]
+            self.steps[lanes] = 0
+
+        return self.states
+
+    def step(self, actions):
+        """Apply one action index per lane.
+
+           Returns (next_states, rewards, dones). next_states are the states
+           reached, before lanes that are done are reset; truncated tells
+           which of the done lanes ran out of steps."""
+
+        actions = np.asarray(actions)
+        rewards = self.mdp.reward(self.states, actions)
+        next_states = self.mdp.sample(self.states, actions, self.random.random())
+
+        self.steps += 1
+        terminal = self.mdp.is_terminal(next_states)
+        self.truncated = ~terminal
+        if self.max_steps is not None:
+            self.truncated &= self.steps >= self.max_steps
+        else:
+            self.truncated[:] = False
+        dones = terminal | self.truncated
+
+        self.states = next_states.copy()
+        if dones.any():
+            self.reset(np.flatnonzero(dones))
+
+        return next_states, rewards, dones
+
+    def positions(self, states=None):
+        """(x, y) positions of states (default: the current states), N x 2."""
+        return self.mdp.locate(self.states if states is None else states)
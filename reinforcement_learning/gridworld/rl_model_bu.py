@@ -148,19 +148,35 @@ def random_policy(state):
     return [action]
 
 
-def policy_evaluation(environment, policy, initial_value_function):
-    
-    value_function = initial_value_function
-    value_function_shape = value_function.shape
-    
-    for state in environment.states:
+def policy_evaluation(environment, policy, initial_value_function, gamma=1.0, tol=1e-6, max_iter=1000):
+    """Iterative policy evaluation on the (width, height) grid.
 
-        state_x = state[0]
-        state_y = state[1]
-        
-#       for 
-        
-#       value_function 
+       - policy: (width, height, nactions) array of action probabilities
+       - initial_value_function: (width, height) array
+
+       The next state of every (state, action) pair is computed once, the
+       sweeps are then vectorised over all states."""
+
+    value_function = np.array(initial_value_function, dtype=float)
+    x, y = environment.states.T
+
+    next_states = np.array([[environment.transition(tuple(state), action)
+                             for action in range(environment.nactions)]
+                            for state in environment.states])
+    next_x, next_y = next_states[...,0], next_states[...,1]
+
+    probabilities = np.asarray(policy, dtype=float)[x, y]
+    expected_reward = np.sum(probabilities*environment.rewards[x, y], 1)
+
+    for iteration in range(max_iter):
+        new_values = expected_reward + gamma*np.sum(probabilities*value_function[next_x, next_y], 1)
+        delta = np.max(np.abs(new_values - value_function[x, y]))
+        value_function[x, y] = new_values
+
+        if delta < tol:
+            break
+
+    return value_function
 
 
 ACTION_LABELS = { 